@@ -0,0 +1,47 @@
+-- multi-cart archive: index + independently compressed assets
+-- see tools/make.py layout_archive for layout
+-- note: include codecs after this file (plain.lua, lzs.lua, lzb.lua)
+local _decoders,_archive,_index={}
+
+-- read the asset index from first cart
+function load_archive(cart)
+	_archive,_index=cart,{}
+	reload(0,0,0x4300,cart.."_0.p8")
+	local mem=0
+	mpeek=function()
+		local b=@mem
+		mem+=1
+		return b
+	end
+	unpack_array(function()
+		_index[unpack_string()]={cart=mpeek(),offset=unpack_variant(),size=unpack_variant(),codec=mpeek()}
+	end)
+	-- restore cart data
+	reload()
+end
+
+-- decode the named asset (only reloads carts holding the asset)
+function load_asset(name,fn,...)
+	local entry=assert(_index[name],"unknown asset: "..name)
+	local cart_id,mem=entry.cart,entry.offset
+	reload(0,0,0x4300,_archive.."_"..cart_id..".p8")
+
+	local function read()
+		-- switch cart as needed (assets larger than a cart)
+		if mem>0x42ff then
+			cart_id+=1
+			mem=0
+			reload(0,0,0x4300,_archive.."_"..cart_id..".p8")
+		end
+		local b=@mem
+		mem+=1
+		return b
+	end
+	-- register global mpeek function
+	mpeek=assert(_decoders[entry.codec],"unsupported codec: "..entry.codec)(read)
+	-- deserialize in context
+	local r=fn(...)
+	-- restore cart data
+	reload()
+	return r
+end
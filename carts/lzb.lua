@@ -0,0 +1,43 @@
+-- lzb unpacking function (byte-aligned lz)
+-- see tools/lzs.py ByteCodec for stream layout
+_decoders[2]=function(read)
+	-- 255 terminated length extension
+	local function ext(n)
+		if n==15 then
+			repeat
+				local b=read()
+				n+=b
+			until b!=255
+		end
+		return n
+	end
+
+	-- ring buffer of 1<<o bytes (no table shifting)
+	local o=read()
+	local mask,wide,history,pos,lits,len,offset=(1<<o)-1,o>8,{},0,0,0
+
+	-- byte reader
+	return function()
+		if lits+len==0 then
+			-- next sequence
+			local t=read()
+			lits,len=ext(t\16),t&15
+			if len>0 then
+				offset=read()+1
+				if(wide) offset+=read()<<8
+				len=ext(len)+(wide and 3 or 2)
+			end
+		end
+		local b
+		if lits>0 then
+			lits-=1
+			b=read()
+		else
+			len-=1
+			b=history[(pos-offset)&mask]
+		end
+		history[pos&mask]=b
+		pos+=1
+		return b
+	end
+end
@@ -1,26 +1,12 @@
 -- lzs unpacking function
 -- credits: https://www.excamera.com/sphinx/article-compression.html
-function decompress(cart,cart_id,mem,fn,...)
-	-- jump to cart
-	reload(0,0,0x4300,cart.."_"..cart_id..".p8")
-
-	local function read()
-		-- switch cart as needed
-		if mem>0x42ff then
-			cart_id+=1
-			mem=0
-			reload(0,0,0x4300,cart.."_"..cart_id..".p8")
-		end	
-		local b=@mem
-		mem+=1
-		return b
-	end
-
-	local dst,history,src,mask={},{},read(),1
+_decoders[1]=function(read)
+	-- note: next byte is read on demand (no read past last byte)
+	local dst,history,src,mask={},{},0,0x100
 	local function get1()		
+    if(mask>0x80) src=read() mask=1
 		local r=(src&mask)!=0 and 1 or 0
     mask<<=1
-    if(mask>0x80) src=read() mask=1
     return r
 	end
 	local function getn(n)
@@ -38,8 +24,8 @@ function decompress(cart,cart_id,mem,fn,...)
 		if(#history>max_offset) deli(history,1)
 	end
 
-	-- register global mpeek function
-	mpeek=function()		
+	-- byte reader
+	return function()		
 		if #dst==0 then
 			-- fetch more data
 			if get1()==0 then
@@ -54,6 +40,4 @@ function decompress(cart,cart_id,mem,fn,...)
 		-- pop first byte		
 		return deli(dst,1)
 	end
-	-- deserialize in context	
-	return fn(...)
 end
\ No newline at end of file
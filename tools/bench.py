@@ -0,0 +1,262 @@
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import tracemalloc
+import subprocess
+import numpy as np
+from dotdict import dotdict
+from packer import *
+from geometry import *
+from bsp import build_bsp, BSPError
+from decimate import decimate
+from lzs import Codec, ByteCodec
+from python2pico import to_multicart, minify_file, cart_data_len
+from make import layout_archive
+
+# asset toolchain benchmark suite (no Blender/PICO-8 required)
+# each stage runs on synthetic data of several sizes and reports:
+# best wall time, throughput, peak traced memory and compression ratio (codecs)
+# results are saved as JSON, --baseline compares with a previous run (exit code 1 on regression)
+
+local_dir = os.path.dirname(os.path.realpath(__file__))
+
+# real-shaped mesh: n x n quads terrain (rolling hills), split vertices (4 per face, as Blender split normals)
+# a few faces are in "frame:<n>" vertex groups
+def terrain_mesh(nfaces, seed=1):
+    rnd = np.random.default_rng(seed)
+    n = max(int(round(np.sqrt(nfaces))), 2)
+    x, z = np.meshgrid(np.linspace(-16, 16, n+1), np.linspace(-16, 16, n+1), indexing='ij')
+    y = 2*np.sin(x/3)*np.cos(z/4) + np.sin(x*z/32) + rnd.uniform(-0.05, 0.05, size=x.shape)
+    grid = np.stack([x, z, y], axis=-1).reshape((-1,3))
+    # quad corners (counter-clockwise)
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    corners = np.stack([i*(n+1)+j, (i+1)*(n+1)+j, (i+1)*(n+1)+j+1, i*(n+1)+j+1], axis=-1).reshape((-1,4))
+    nf = len(corners)
+    verts = grid[corners.reshape(-1)]
+    p = verts.reshape((nf,4,3))
+    normals = np.cross(p[:,2]-p[:,0], p[:,3]-p[:,1])
+    normals /= np.linalg.norm(normals, axis=1)[:,None]
+    groups = rnd.choice(nf, size=min(nf, 16), replace=False)
+    return dotdict(
+        verts=verts,
+        loop_vert=np.arange(4*nf, dtype=np.int32),
+        loop_start=np.arange(0, 4*nf, 4, dtype=np.int32),
+        loop_total=np.full(nf, 4, dtype=np.int32),
+        material=rnd.integers(0, 4, size=nf).astype(np.int32),
+        normals=normals,
+        vgroup_names={gi: "frame:{}".format(gi) for gi in range(len(groups))},
+        group_vert=np.arange(4*nf, dtype=np.int32).reshape((nf,4))[groups].reshape(-1),
+        group_index=np.repeat(np.arange(len(groups), dtype=np.int32), 4),
+        group_weight=np.ones(4*len(groups), dtype=np.float32))
+
+# convex hull: uv sphere of about nverts vertices, returns (face normals, face distances, vertices)
+def sphere_hull(nverts, r=8.0):
+    nlon = max(int(np.sqrt(2*nverts)), 4)
+    nlat = max(nlon//2, 2)
+    th, ph = np.meshgrid(np.linspace(0, np.pi, nlat+1), np.linspace(0, 2*np.pi, nlon+1)[:-1], indexing='ij')
+    points = r*np.stack([np.sin(th)*np.cos(ph), np.sin(th)*np.sin(ph), np.cos(th)], axis=-1)
+    i, j = np.meshgrid(np.arange(nlat), np.arange(nlon), indexing='ij')
+    # quad planes from 3 corners (south pole row: the other triangle, quads are degenerate at the poles)
+    south = (i==nlat-1)[...,None]
+    a, b = points[i, j], points[i+1, (j+1)%nlon]
+    c = np.where(south, points[i, (j+1)%nlon], points[i+1, j])
+    normals = np.cross(b-a, c-a).reshape((-1,3))
+    normals /= np.linalg.norm(normals, axis=1)[:,None]
+    # pointing outside
+    normals *= np.sign(np.sum(normals*a.reshape((-1,3)), axis=1))[:,None]
+    dists = np.sum(normals*a.reshape((-1,3)), axis=1)
+    return normals, dists, np.unique(points.reshape((-1,3)).round(9), axis=0)
+
+# model blob with the exporter layout (single lod, no anchors/hulls, see blender_export.export_scene)
+def model_blob(mesh):
+    palette = NormalPalette()
+    normal_ids = palette.indices(palette.snap(mesh.normals))
+    quantizer = vertex_quantizer(mesh.verts)
+    verts, remap = weld_vertices(mesh, range(len(mesh.loop_start)), quantizer)
+    loop_vert = remap[mesh.loop_vert]
+    s = bytearray()
+    s += pack_variant(len(palette.normals)) + pack_vectors_array(palette.normals)
+    s += pack_byte(quantizer.nbytes) + pack_vectors_array([quantizer.origin]) + pack_fixed(quantizer.scale)
+    # anchors, hulls, lods
+    s += pack_variant(0) + pack_variant(0) + pack_variant(1)
+    s += pack_variant(64)
+    s += pack_variant(len(verts)) + quantizer.pack(verts)
+    s += pack_variant(len(mesh.loop_start))
+    for fi,normal_id in enumerate(normal_ids):
+        start, total = mesh.loop_start[fi], mesh.loop_total[fi]
+        s += pack_byte(total==4 and 0x2 or 0) + pack_byte(int(mesh.material[fi]) + 1)
+        s += pack_variants(loop_vert[start:start+total] + 1)
+        s += pack_variant(normal_id+1)
+    # no BSP nodes
+    s += pack_variant(0)
+    return bytes(s)
+
+# archive blob of the given size: model blobs of growing meshes (truncated)
+def archive_blob(size):
+    s = bytearray()
+    nfaces = 64
+    while len(s) < size:
+        s += model_blob(terrain_mesh(nfaces, seed=nfaces))
+        nfaces *= 2
+    return bytes(s[:size])
+
+# synthetic Lua source for the minifier (copies of the game cart code)
+def lua_source(size):
+    with open(os.path.join(local_dir, "..", "carts", "game.p8"), "r", encoding='utf-8') as f:
+        code = f.read()
+    code = code[:code.index("__gfx__")]
+    return (code * (size // len(code) + 1))[:size]
+
+# stage: (name, sizes, unit, setup(size) -> input, run(input) -> result, ratio(input, result) or None)
+def stages(tmp_dir):
+    def to_carts(b):
+        for name in os.listdir(tmp_dir):
+            os.unlink(os.path.join(tmp_dir, name))
+        return to_multicart(b, None, tmp_dir, "dat")
+    def minify(path):
+        return minify_file(path, path + ".min")
+    def lua_file(size):
+        path = os.path.join(tmp_dir, "src_{}.lua".format(size))
+        with open(path, "w", encoding='utf-8') as f:
+            f.write(lua_source(size))
+        return path
+    # regression: index length alternated between 15 and 16 bytes with these sizes (layout never returned)
+    def index_fixpoint(size):
+        return [("a", "raw", bytes(size)), ("b", "raw", bytes(cart_data_len - 15 - size))]
+    def layout_fixpoint(assets):
+        blob, entries = layout_archive(assets)
+        assert [(e.cart, e.offset) for e in entries]==[(0, 16), (1, 0)], entries
+        return blob
+    def hull(sphere):
+        normals, dists, points = sphere
+        planes, verts = hull_planes(normals, dists, points=points)
+        assert len(verts)>=4 and np.all(points @ normals[planes].T - dists[planes] <= 1/256), len(planes)
+        return planes
+    def compressed_ratio(b, out):
+        return len(out)/len(b)
+    def bsp(mesh):
+        polygons = list(range(len(mesh.loop_start)))
+        try:
+            return build_bsp(mesh, polygons, {}, np.full(len(polygons), -1, dtype=np.int32), vertex_quantizer(mesh.verts))
+        except BSPError:
+            return None
+    blob_sizes = [1024, 4096, 16384, 32768]
+    face_sizes = [1000, 10000, 100000]
+    return [
+        ("lzs", blob_sizes, "bytes", archive_blob, lambda b: Codec(b_off=8, b_len=3).toarray(b), compressed_ratio),
+        ("lzs_optimal", blob_sizes, "bytes", archive_blob, lambda b: Codec(b_off=8, b_len=3, optimal=True).toarray(b), compressed_ratio),
+        ("lzb", blob_sizes, "bytes", archive_blob, lambda b: ByteCodec(b_off=8).toarray(b), compressed_ratio),
+        ("layout_archive", blob_sizes, "bytes", archive_blob, lambda b: layout_archive([("model_{}".format(i), "raw", b[i:i+1024]) for i in range(0, len(b), 1024)]), None),
+        ("layout_index_fixpoint", [1000], "bytes", index_fixpoint, layout_fixpoint, None),
+        ("to_multicart", blob_sizes, "bytes", archive_blob, to_carts, None),
+        ("minify_file", [16384, 65536], "bytes", lua_file, minify, None),
+        ("pack_variants", [1000, 100000], "values", lambda n: np.random.default_rng(n).integers(0, 0x7fff, size=n).tolist(), pack_variants, None),
+        ("pack_doubles", [1000, 100000], "values", lambda n: np.random.default_rng(n).uniform(-64, 64, size=n).tolist(), pack_doubles, None),
+        ("face_groups", face_sizes, "faces", terrain_mesh, face_groups, None),
+        ("weld_vertices", face_sizes, "faces", terrain_mesh, lambda mesh: weld_vertices(mesh, range(len(mesh.loop_start)), vertex_quantizer(mesh.verts)), None),
+        ("vertex_pack", face_sizes, "faces", terrain_mesh, lambda mesh: vertex_quantizer(mesh.verts).pack(mesh.verts), None),
+        ("hull_planes", [3000], "vertices", sphere_hull, hull, None),
+        ("normal_palette", [1000, 10000], "faces", terrain_mesh, lambda mesh: NormalPalette().snap(mesh.normals), None),
+        ("model_blob", [1000, 10000], "faces", terrain_mesh, model_blob, None),
+        ("decimate", [1000, 10000], "faces", terrain_mesh, lambda mesh: decimate(mesh, vertex_quantizer(mesh.verts)), None),
+        ("bsp", [1000], "faces", terrain_mesh, bsp, None),
+    ]
+
+# best wall time of repeat runs, peak traced memory of an extra run
+def measure(run, data, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = run(data)
+        elapsed = time.perf_counter() - start
+        best = best is None and elapsed or min(best, elapsed)
+    gc.collect()
+    tracemalloc.start()
+    run(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=local_dir, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+# regressions of results against baseline results: list of messages
+# time/memory: relative threshold, ratio: absolute threshold
+# stages faster than min_time (both runs) are too noisy to compare
+def compare(results, baseline, threshold, ratio_threshold, min_time):
+    regressions = []
+    for key, r in results.items():
+        b = baseline.get(key)
+        if b is None:
+            continue
+        if max(r["seconds"], b["seconds"]) >= min_time and r["seconds"] > b["seconds"]*(1+threshold):
+            regressions.append("{}: time {:.4f}s -> {:.4f}s (+{:.0f}%)".format(key, b["seconds"], r["seconds"], 100*(r["seconds"]/b["seconds"]-1)))
+        if r["peak_kb"] > b["peak_kb"]*(1+threshold) and r["peak_kb"]-b["peak_kb"] > 64:
+            regressions.append("{}: peak memory {}KB -> {}KB".format(key, b["peak_kb"], r["peak_kb"]))
+        if r.get("ratio") is not None and b.get("ratio") is not None and r["ratio"] > b["ratio"] + ratio_threshold:
+            regressions.append("{}: ratio {:.4f} -> {:.4f}".format(key, b["ratio"], r["ratio"]))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Asset toolchain benchmarks')
+    parser.add_argument('--out', type=str, help='Save results to JSON file')
+    parser.add_argument('--baseline', type=str, help='Compare with results of a previous run (JSON file), exit code 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Max. relative time/memory increase (default: %(default)s)')
+    parser.add_argument('--ratio-threshold', type=float, default=0.005, help='Max. compression ratio increase (default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.002, help='Timings below this duration (seconds) are not compared (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per stage (default: %(default)s)')
+    parser.add_argument('--stages', type=str, nargs='+', help='Stages to run (default: all)')
+    parser.add_argument('--quick', action='store_true', help='Smallest size of each stage only')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, sizes, unit, setup, run, ratio in stages(tmp_dir):
+            if args.stages and name not in args.stages:
+                continue
+            for size in (args.quick and sizes[:1] or sizes):
+                data = setup(size)
+                result, seconds, peak = measure(run, data, args.repeat)
+                key = "{}/{}".format(name, size)
+                results[key] = dict(
+                    stage=name,
+                    size=size,
+                    unit=unit,
+                    seconds=seconds,
+                    throughput=size/max(seconds, 1e-9),
+                    peak_kb=peak//1024,
+                    ratio=ratio and ratio(data, result) or None)
+                print("{:<28} {:>10.4f}s {:>14,.0f} {}/s peak: {:>8}KB{}".format(
+                    key, seconds, size/max(seconds, 1e-9), unit, peak//1024, ratio and " ratio: {:.3f}".format(results[key]["ratio"]) or ""))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(dict(
+                commit=git_commit(),
+                python=platform.python_version(),
+                numpy=np.__version__,
+                machine=platform.machine(),
+                results=results), f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.threshold, args.ratio_threshold, args.min_time)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+        print("No regression against: {} (commit: {})".format(args.baseline, baseline.get("commit")))
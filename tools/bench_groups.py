@@ -0,0 +1,80 @@
+import time
+import argparse
+import numpy as np
+from collections import defaultdict
+from dotdict import dotdict
+from geometry import face_verts, face_groups
+
+# face to vertex group resolution benchmark (no Blender required)
+# compares the per-face group counting (previous exporter) with vertex group bitmasks
+
+# synthetic mesh: random tris/quads, ngroups animation frames/decals made of disjoint faces
+def synthetic_mesh(nverts, nfaces, ngroups, seed=1):
+    rnd = np.random.default_rng(seed)
+    loop_total = rnd.choice([3,3,4], size=nfaces).astype(np.int32)
+    loop_start = np.zeros(nfaces, dtype=np.int32)
+    loop_start[1:] = np.cumsum(loop_total)[:-1]
+    loop_vert = rnd.integers(0, nverts, size=int(loop_total.sum()), dtype=np.int32)
+
+    vgroup_names = {}
+    group_vert, group_index = [], []
+    faces = rnd.choice(nfaces, size=min(nfaces, 4*ngroups), replace=False)
+    for gi in range(ngroups):
+        vgroup_names[gi] = gi%2 and "decal:frame:{}".format(gi-1) or "frame:{}".format(gi)
+        # a few faces per group (+ shared vertices with random neighbours)
+        for fi in faces[4*gi:4*gi+4].tolist():
+            verts = face_verts(dotdict(loop_start=loop_start, loop_total=loop_total, loop_vert=loop_vert), fi)
+            group_vert.extend(verts.tolist())
+            group_index.extend([gi]*len(verts))
+    # vertices can be in several groups
+    pairs = sorted(set(zip(group_vert, group_index)))
+    return dotdict(
+        verts=rnd.uniform(-8, 8, size=(nverts,3)),
+        loop_vert=loop_vert,
+        loop_start=loop_start,
+        loop_total=loop_total,
+        vgroup_names=vgroup_names,
+        group_vert=np.array([vi for vi,_ in pairs], dtype=np.int32),
+        group_index=np.array([gi for _,gi in pairs], dtype=np.int32))
+
+# previous exporter code
+def face_groups_counting(mesh):
+    vgroups = defaultdict(list)
+    for vi,gi in zip(mesh.group_vert.tolist(), mesh.group_index.tolist()):
+        vgroups[vi].append(mesh.vgroup_names[gi])
+    gname_by_face = {}
+    for fi in range(len(mesh.loop_start)):
+        counts = defaultdict(int)
+        verts = face_verts(mesh, fi)
+        for vi in verts.tolist():
+            for gname in vgroups[vi]:
+                counts[gname] +=1
+        for gname,count in counts.items():
+            if count == len(verts):
+                if fi in gname_by_face:
+                    raise Exception("Face: {} already registered in group: {}".format(fi, gname_by_face[fi]))
+                gname_by_face[fi] = gname
+    return gname_by_face
+
+def timed(fn, *args):
+    t = time.perf_counter()
+    r = fn(*args)
+    return r, time.perf_counter() - t
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Face group resolution benchmark')
+    parser.add_argument('--verts', type=int, default=25000, help='Number of vertices')
+    parser.add_argument('--faces', type=int, default=50000, help='Number of faces')
+    parser.add_argument('--groups', type=int, default=[8, 64, 256], nargs='+', help='Number of vertex groups')
+    args = parser.parse_args()
+
+    for ngroups in args.groups:
+        mesh = synthetic_mesh(args.verts, args.faces, ngroups)
+        legacy, t_legacy = timed(face_groups_counting, mesh)
+        face_group, t_mask = timed(face_groups, mesh)
+        # same assignments
+        masked = {fi: mesh.vgroup_names[int(face_group[fi])] for fi in np.flatnonzero(face_group>=0).tolist()}
+        if masked != legacy:
+            raise Exception("Group assignment mismatch ({} groups)".format(ngroups))
+        print("faces: {} groups: {:>4} grouped faces: {:>5} counting: {:.3f}s bitmask: {:.3f}s (x{:.1f})".format(
+            args.faces, ngroups, len(masked), t_legacy, t_mask, t_legacy/max(t_mask,1e-9)))
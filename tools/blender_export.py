@@ -4,94 +4,17 @@ import argparse
 import sys
 import os
 import re
+import json
 from mathutils import Vector, Matrix
-from collections import defaultdict
-
-# pack helpers
-def tohex(val, nbits):
-    return (hex((int(round(val,0)) + (1<<nbits)) % (1<<nbits))[2:]).zfill(nbits>>2)
-
-# variable length packing (1 or 2 bytes)
-def pack_variant(x):
-    x=int(x)
-    if x>0x7fff:
-      raise Exception('Unable to convert: {} into a 1 or 2 bytes'.format(x))
-    # 2 bytes
-    if x>127:
-        h = "{:04x}".format(x + 0x8000)
-        if len(h)!=4:
-            raise Exception('Unable to convert: {} into a word: {}'.format(x,h))
-        return h
-    # 1 byte
-    h = pack_byte(x)
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-
-# single byte (unsigned short)
-def pack_byte(x):
-    h = tohex(x,8)
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-    
-# short must be between -32000/32000
-def pack_int(x):
-    h = tohex(x,16)
-    if len(h)!=4:
-        raise Exception('Unable to convert: {} into a word: {}'.format(x,h))
-    return h
-
-def pack_int32(x):
-    h = tohex(x,32)
-    if len(h)!=8:
-        raise Exception('Unable to convert: {} into a dword: {}'.format(x,h))
-    return h
-
-# 16:16 fixed point value
-# 4 bytes
-def pack_fixed(x):
-    h = tohex(int(x*(1<<16)),32)
-    if len(h)!=8:
-        raise Exception('Unable to convert: {} into a dword: {}'.format(x,h))
-    return h
-
-# short must be between -127/127
-def pack_short(x):
-    h = pack_byte(int(round(x+128,0)))
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-
-# float must be between -4/+3.968 resolution: 0.03125
-# 1 byte
-def pack_float(x):
-    h = pack_byte(int(round(32*x+128,0)))
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-# double must be between -128/+127 resolution: 0.0078
-# 2 bytes
-def pack_double(x):
-    h = "{}".format(tohex(128*x+16384,16))
-    if len(h)!=4:
-        raise Exception('Unable to convert: {} into a word: {}'.format(x,h))
-    return h
-
-argv = sys.argv
-if "--" not in argv:
-    argv = []
-else:
-   argv = argv[argv.index("--") + 1:]
-
-try:
-    parser = argparse.ArgumentParser(description='Exports Blender model as a byte array',prog = "blender -b -P "+__file__+" --")
-    parser.add_argument('-o','--out', help='Output file', required=True, dest='out')
-    args = parser.parse_args(argv)
-except Exception as e:
-    sys.exit(repr(e))
+import numpy as np
 
-scene = bpy.context.scene
+# shared pack helpers (Blender does not add script folder to path)
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from packer import *
+from geometry import *
+from bsp import build_bsp, BSPError
+from decimate import decimate, triangle_count
+from dotdict import dotdict
 
 # https://blender.stackexchange.com/questions/153048/blender-2-8-python-input-rgb-doesnt-match-hex-color-nor-actual-color
 # seriously???
@@ -139,7 +62,7 @@ solid_db = {
 
 # Convert from Blender format to y-up format
 def pack_vector(co):
-    return "{}{}{}".format(pack_double(co.x), pack_double(co.z), pack_double(co.y))
+    return pack_vectors([(co.x, co.z, co.y)])
 
 # face flags bit layout:
 FACE_FLAG_TRANSPARENT = 0x20
@@ -149,42 +72,70 @@ FACE_FLAG_EDGES = 0x4
 FACE_FLAG_QUAD = 0x2
 FACE_FLAG_DUALSIDED=0x1
 
-def pack_face(f, obcontext, loop_vert, gname=None, decals = None):
-    s = ""
+# bulk extraction of mesh data (numpy arrays)
+def extract_mesh(obcontext):
+    obdata = obcontext.data
+    mesh = dotdict()
+    nv, nl, nf = len(obdata.vertices), len(obdata.loops), len(obdata.polygons)
+
+    co = np.empty(3*nv, dtype=np.float32)
+    obdata.vertices.foreach_get("co", co)
+    mesh.verts = co.reshape((nv,3)).astype(np.float64)
+
+    mesh.loop_vert = np.empty(nl, dtype=np.int32)
+    obdata.loops.foreach_get("vertex_index", mesh.loop_vert)
+
+    mesh.loop_start = np.empty(nf, dtype=np.int32)
+    obdata.polygons.foreach_get("loop_start", mesh.loop_start)
+    mesh.loop_total = np.empty(nf, dtype=np.int32)
+    obdata.polygons.foreach_get("loop_total", mesh.loop_total)
+    mesh.material = np.empty(nf, dtype=np.int32)
+    obdata.polygons.foreach_get("material_index", mesh.material)
+    normals = np.empty(3*nf, dtype=np.float32)
+    obdata.polygons.foreach_get("normal", normals)
+    mesh.normals = normals.reshape((nf,3)).astype(np.float64)
+
+    # vertex group weights (no bulk API for variable length data)
+    mesh.vgroup_names = {vgroup.index: vgroup.name for vgroup in obcontext.vertex_groups}
+    pairs = [(v.index, g.group, g.weight) for v in obdata.vertices for g in v.groups]
+    mesh.group_vert = np.array([vi for vi,_,_ in pairs], dtype=np.int32)
+    mesh.group_index = np.array([gi for _,gi,_ in pairs], dtype=np.int32)
+    mesh.group_weight = np.array([w for _,_,w in pairs], dtype=np.float32)
+    return mesh
+
+# flags and color of each material slot
+def material_flags(obcontext):
+    materials = []
+    for slot in obcontext.material_slots:
+        mat = slot.material
+        dualsided_bit = mat.use_backface_culling==False and FACE_FLAG_DUALSIDED or 0
+        edges_bit = mat.get('edges')=="true" and FACE_FLAG_EDGES or 0
+        transparency_bit = mat.diffuse_color[3]<1.0 and FACE_FLAG_TRANSPARENT or 0
+        materials.append((transparency_bit | edges_bit | dualsided_bit, diffuse_to_p8color(mat.diffuse_color)))
+    return materials
+
+def pack_face(fi, mesh, materials, frame_id=-1, decals = None):
+    s = bytearray()
     # face flags
     decals_bit = decals and FACE_FLAG_DECALS or 0
-    dualsided_bit = 0
-    transparency_bit = 0
 
     # default color
     color = 1   
+    material_bits = 0
 
     # "animation" frame?
-    animframe_bit = 0
-    frame_id = -1    
-    if gname:
-        frame_re = re.compile(r"frame:([0-9]+)")
-        result = frame_re.match(gname)
-        if result:
-            animframe_bit = FACE_FLAG_ANIMFRAME
-            frame_id = int(result.groups()[0])
+    animframe_bit = frame_id != -1 and FACE_FLAG_ANIMFRAME or 0
     
-    vlen = len(f.loop_indices)
+    vlen = mesh.loop_total[fi]
     if vlen<3 or vlen>4:
         raise Exception("Only tri or quad supported (#verts: {})".format(vlen))
 
     quad_bit = vlen==4 and FACE_FLAG_QUAD or 0
-    edges_bit = 0
-    if len(obcontext.material_slots)>0:
-        slot = obcontext.material_slots[f.material_index]
-        mat = slot.material
-        dualsided_bit = mat.use_backface_culling==False and FACE_FLAG_DUALSIDED or 0
-        color = diffuse_to_p8color(mat.diffuse_color)
-        edges_bit = mat.get('edges')=="true" and FACE_FLAG_EDGES or 0
-        transparency_bit = mat.diffuse_color[3]<1.0 and FACE_FLAG_TRANSPARENT or 0
+    if materials:
+        material_bits, color = materials[mesh.material[fi]]
     
     # flags
-    s += pack_byte(transparency_bit | animframe_bit | decals_bit | edges_bit | quad_bit | dualsided_bit)
+    s += pack_byte(material_bits | animframe_bit | decals_bit | quad_bit)
 
     # color + frame number (if any)
     s += pack_byte(color)
@@ -194,134 +145,212 @@ def pack_face(f, obcontext, loop_vert, gname=None, decals = None):
         s += pack_byte(frame_id)
 
     # + vertex ids (= edge loop)
-    for li in f.loop_indices:
-        s += pack_variant(loop_vert[li]+1) 
+    s += pack_variants(face_verts(mesh, fi) + 1)
 
     if decals:
         s += pack_variant(len(decals)) 
         for decal_face in decals:
-            s += pack_face(decal_face, obcontext, loop_vert)
+            s += pack_face(decal_face, mesh, materials)
     return s  
 
-def export_layer(layer):
-    # data
-    s = ""
-    
+# mesh and materials of a lod collection
+def layer_mesh(layer):
     # pick object named "model"
     obcontext = [o for o in layer.objects if o.name == 'model'][0]
-    obdata = obcontext.data
-    bm = bmesh.new()
-    bm.from_mesh(obdata)
-
-    # create vertex group lookup dictionary for names
-    vgroup_names = {vgroup.index: vgroup.name for vgroup in obcontext.vertex_groups}
-    # create dictionary of vertex group assignments per vertex
-    vgroups = {v.index: [vgroup_names[g.group] for g in v.groups] for v in obdata.vertices}
-
-    # create a map loop index -> vertex index (see: https://www.python.org/dev/peps/pep-0274/)
-    loop_vert = {l.index:l.vertex_index for l in obdata.loops}
-
-    # Blender vgroup API sillyness...
-    gname_by_face = {}
-    face_by_gname = {}
-    for f in obdata.polygons:
-        counts = defaultdict(int)
-        # count number of vertices per group
-        for li in f.loop_indices:
-            vi = loop_vert[li]
-            for gname in vgroups[vi]:
-                counts[gname] +=1
-        # face is in group if all vertices are in a given group
-        for gname,count in counts.items():
-            if count == len(f.loop_indices):
-                if f in gname_by_face:
-                    raise Exception("Face: {} already registered in group: {}".format(f.index, gname_by_face[f]))
-                gname_by_face[f] = gname
-                face_by_gname[gname] = f
-
-    # find decal faces
-    decal_faces_by_parent = defaultdict(set)  
-    decal_faces = set()
-    decal_re = re.compile(r"decal:(.+)")
-    for f, gname in gname_by_face.items():
-        result = decal_re.match(gname)
-        # find group name
-        if result:
-            decal_gname = result.groups()[0]
-            if decal_gname in face_by_gname:
-                # parent group => face
-                parent = face_by_gname[decal_gname]
-                decal_faces_by_parent[parent].add(f)
-                decal_faces.add(f)
-
-    # all vertices
-    s += pack_variant(len(obdata.vertices))
-    for v in obdata.vertices:
-        s += pack_vector(v.co)
+    return extract_mesh(obcontext), material_flags(obcontext)
+
+def export_layer(mesh, materials, lod_name, palette, quantizer):
+    # data
+    s = bytearray()
+
+    # face group (if any) from vertex group bitmasks
+    face_group = face_groups(mesh)
+    frame_by_face, decal_faces_by_parent, decal_faces = face_frames_and_decals(mesh, parse_groups(mesh.vgroup_names), face_group)
 
     # faces (remove decal faces)
-    polygons = list([p for p in obdata.polygons if p not in decal_faces])
+    polygons = [fi for fi in range(len(mesh.loop_start)) if fi not in decal_faces]
+
+    # use shared normals (decal normals are not exported)
+    normals = mesh.normals.copy()
+    normals[polygons] = palette.snap(normals[polygons])
+    mesh = dotdict(mesh, normals=normals)
+
+    # static draw order
+    nodes = []
+    if args.bsp:
+        try:
+            mesh, polygons, decal_faces_by_parent, frame_by_face, nodes, stats = build_bsp(mesh, polygons, decal_faces_by_parent, frame_by_face, quantizer, normal_error=args.normal_error)
+            print("{}: BSP depth: {} nodes: {} split faces: {} faces: {} -> {}".format(lod_name, stats.depth, stats.nodes, stats.splits, stats.faces, stats.bsp_faces))
+        except BSPError as e:
+            # runtime sorting
+            print("{}: BSP skipped - {}".format(lod_name, e))
+
+    # merge identical (once quantized) vertices + number them by first use
+    if not args.no_weld:
+        faces = [face for fi in polygons for face in [fi] + decal_faces_by_parent.get(fi, [])]
+        verts, remap = weld_vertices(mesh, faces, quantizer)
+        mesh = dotdict(mesh, verts=verts, loop_vert=remap[mesh.loop_vert])
+
+    # all vertices (model encoding)
+    s += pack_variant(len(mesh.verts))
+    s += quantizer.pack(mesh.verts)
+
+    normal_ids = palette.indices(mesh.normals[polygons])
     s += pack_variant(len(polygons))
-    for f in polygons:
-        s += pack_face(f, obcontext, loop_vert, gname=gname_by_face.get(f,None), decals = decal_faces_by_parent.get(f, None))      
+    for fi,normal_id in zip(polygons,normal_ids):
+        s += pack_face(fi, mesh, materials, frame_id=int(frame_by_face[fi]), decals = decal_faces_by_parent.get(fi, None))      
+
+        # normal (palette index)
+        s += pack_variant(normal_id+1)
 
-        # normal
-        s += pack_vector(f.normal)    
+    # BSP nodes (if any), in pre-order: number of faces (in faces order), children flags
+    s += pack_variant(len(nodes))
+    for count, children in nodes:
+        s += pack_variant(count)
+        s += pack_byte(children)
 
     return s
 
 # model data
-s = ""
-
-# misc model data
-# anchor positions (if any)
-anchor_re = re.compile(r"anchor:([0-9]+)")
-anchors = {o:anchor_re.match(o.name) for o in scene.objects if o.type == 'EMPTY' and anchor_re.match(o.name)}
-s += pack_variant(len(anchors))
-for anchor,result in anchors.items():
-    # anchor id
-    s += pack_byte(int(result.groups()[0]))
-    # anchor location
-    s += pack_vector(anchor.location)
-    # anchor direction (y axis)
-    s += pack_vector(anchor.matrix_world[1])
-
-# collision jull
-hull_re = re.compile(r"hull:([0-9]+)")
-hulls = {o:hull_re.match(o.name) for o in scene.objects if o.type == 'MESH' and hull_re.match(o.name)}
-s += pack_variant(len(hulls))
-for hull,result in hulls.items():
-    # hull id (usefull to find out what has been hit)
-    s += pack_byte(int(result.groups()[0]))
-    # export all planes
-    bm = bmesh.new()
-    bm.from_mesh(hull.data)
-    s += pack_variant(len(bm.faces))
-    for face in bm.faces:
-        # normal
-        s += pack_vector(face.normal)
-        # distance from (0,0,0)
-        s += pack_double(face.normal.dot(face.verts[0].co))
-
-# layers = lod
-ln = 0
-ls = ""
-for i in range(2):
-    lod_name = "lod{}".format(i)
-    if lod_name in scene.collection.children:
-        layer = scene.collection.children[lod_name]
+def export_scene(scene):
+    s = bytearray()
+    # shared normals (faces + hull planes)
+    palette = NormalPalette(args.normal_error)
+
+    # misc model data
+    # anchor positions (if any)
+    anchor_re = re.compile(r"anchor:([0-9]+)")
+    anchors = {o:anchor_re.match(o.name) for o in scene.objects if o.type == 'EMPTY' and anchor_re.match(o.name)}
+    s += pack_variant(len(anchors))
+    for anchor,result in anchors.items():
+        # anchor id
+        s += pack_byte(int(result.groups()[0]))
+        # anchor location
+        s += pack_vector(anchor.location)
+        # anchor direction (y axis)
+        s += pack_vector(anchor.matrix_world[1])
+
+    # collision jull
+    hull_re = re.compile(r"hull:([0-9]+)")
+    hulls = {o:hull_re.match(o.name) for o in scene.objects if o.type == 'MESH' and hull_re.match(o.name)}
+    s += pack_variant(len(hulls))
+    for hull,result in hulls.items():
+        # hull id (usefull to find out what has been hit)
+        s += pack_byte(int(result.groups()[0]))
+        # export all planes
+        bm = bmesh.new()
+        bm.from_mesh(hull.data)
+        normals = [tuple(face.normal) for face in bm.faces]
+        dists = [face.normal.dot(face.verts[0].co) for face in bm.faces]
+        # merge/drop redundant planes
+        planes, verts = hull_planes(normals, dists, points=[tuple(v.co) for v in bm.verts])
+        # open hull (no convex volume): mesh vertices and face distances
+        closed = len(verts)>=4
+        if not closed:
+            verts = [tuple(v.co) for v in bm.verts]
+        # bounding sphere (early out)
+        center, radius = bounding_sphere(verts)
+        print("{}: planes: {} -> {} bounding sphere radius: {}".format(hull.name, len(normals), len(planes), radius))
+        s += pack_vectors_array([center])
+        s += pack_double(radius)
+        s += pack_variant(len(planes))
+        plane_normals = palette.snap([normals[i] for i in planes])
+        for i,n,normal_id in zip(planes,plane_normals,palette.indices(plane_normals)):
+            # normal (palette index)
+            s += pack_variant(normal_id+1)
+            # distance from (0,0,0), convex volume must stay inside shared normal plane
+            if closed:
+                s += pack_double(np.max(verts @ n))
+            else:
+                s += pack_double(dists[i])
+
+    # layers = lod
+    layers = {}
+    for i in range(args.lods):
+        lod_name = "lod{}".format(i)
+        if lod_name in scene.collection.children:
+            layer = scene.collection.children[lod_name]
+            layers[lod_name] = (layer, layer_mesh(layer))
+
+    # vertex encoding: smallest that fits all lods within error budget
+    quantizer = vertex_quantizer([v for _,(mesh,_) in layers.values() for v in mesh.verts.tolist()], args.vertex_error)
+    print("vertices: {} byte(s) per component, origin: {} scale: {}".format(quantizer.nbytes, quantizer.origin.tolist(), quantizer.scale))
+
+    # missing layers are generated from previous lod
+    ln = 0
+    ls = bytearray()
+    mesh, lod_dist = None, 1024
+    for i in range(args.lods):
+        lod_name = "lod{}".format(i)
+        if lod_name in layers:
+            layer, (mesh, materials) = layers[lod_name]
+            lod_dist = int(layer.get("lod_dist", 1024))
+            source = "collection"
+        elif mesh is not None and not args.no_auto_lod:
+            mesh = decimate(mesh, quantizer, ratio=args.lod_ratio, max_error=args.lod_error)
+            # default: twice the previous range (variant encoding: 0x7fff max.)
+            if i < len(args.lod_dist):
+                lod_dist = args.lod_dist[i]
+            else:
+                lod_dist = min(2*lod_dist, 0x7fff)
+            source = "generated"
+        else:
+            # lod numbering discontinued
+            break
         ln += 1
         # LOD visibility range
-        ls += pack_variant(int(layer.get("lod_dist", 1024)))
-        ls += export_layer(layer)
-    else:
-        # lod numbering discontinued
-        break
-# number of active lods
-s += pack_variant(ln)
-s += ls
-
-#
-with open(args.out, 'w') as f:
-    f.write(s)
+        ls += pack_variant(lod_dist)
+        layer_data = export_layer(mesh, materials, lod_name, palette, quantizer)
+        ls += layer_data
+        print("{} ({}): faces: {} triangles: {} bytes: {}".format(lod_name, source, len(mesh.loop_start), triangle_count(mesh), len(layer_data)))
+    # number of active lods
+    s += pack_variant(ln)
+    s += ls
+
+    errors = np.array(palette.errors)
+    print("normals: {} -> {} shared, angular error max: {:.2f} mean: {:.2f} (degrees)".format(len(errors), len(palette.normals), len(errors) and errors.max() or 0, len(errors) and errors.mean() or 0))
+    # normals first
+    header = pack_variant(len(palette.normals)) + pack_vectors_array(palette.normals)
+    # vertex encoding: bytes per component, origin, scale
+    header += pack_byte(quantizer.nbytes) + pack_vectors_array([quantizer.origin]) + pack_fixed(quantizer.scale)
+    return header + s
 
+argv = sys.argv
+if "--" not in argv:
+    argv = []
+else:
+   argv = argv[argv.index("--") + 1:]
+
+try:
+    parser = argparse.ArgumentParser(description='Exports Blender model as a byte array',prog = "blender -b -P "+__file__+" --")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-o','--out', help='Output file (current scene)', dest='out')
+    group.add_argument('-m','--manifest', help='Batch mode: JSON file with a list of {"blend": <.blend file>, "out": <output file>} entries', dest='manifest')
+    parser.add_argument('--bsp', action='store_true', help='Export faces in BSP tree order (static draw order, no sorting)')
+    parser.add_argument('--lods', type=int, default=2, help='Number of LODs, missing lod<n> collections are generated from lod<n-1> (default: %(default)s)')
+    parser.add_argument('--lod-dist', type=int, nargs='+', default=[], help='LOD visibility range of generated LODs, indexed by LOD number, 0-32767 (default: twice the previous LOD range, up to 32767)')
+    parser.add_argument('--lod-ratio', type=float, default=0.5, help='Generated LOD number of triangles, relative to previous LOD (default: %(default)s)')
+    parser.add_argument('--lod-error', type=float, help='Max. geometric error of generated LODs (default: none)')
+    parser.add_argument('--no-auto-lod', action='store_true', help='Export lod<n> collections only')
+    parser.add_argument('--normal-error', type=float, default=1.0, help='Max. angle between a face normal and its shared normal, in degrees (default: %(default)s)')
+    parser.add_argument('--vertex-error', type=float, default=1/32, help='Max. vertex position error (per axis), selects 1 or 2 bytes vertex encoding (default: %(default)s)')
+    parser.add_argument('--no-weld', action='store_true', help='Keep vertices with identical quantized positions')
+    args = parser.parse_args(argv)
+    if any(d<0 or d>0x7fff for d in args.lod_dist):
+        parser.error("--lod-dist values must be in 0-32767 range")
+except Exception as e:
+    sys.exit(repr(e))
+
+def write(path, s):
+    with open(path, 'wb') as f:
+        f.write(s)
+
+if args.manifest:
+    # single Blender session for all models
+    with open(args.manifest, 'r') as f:
+        manifest = json.load(f)
+    for entry in manifest:
+        bpy.ops.wm.open_mainfile(filepath=entry["blend"])
+        write(entry["out"], export_scene(bpy.context.scene))
+else:
+    write(args.out, export_scene(bpy.context.scene))
@@ -0,0 +1,212 @@
+import numpy as np
+from dotdict import dotdict
+from geometry import face_verts, quantize_doubles, dequantize_doubles
+
+# static draw order: binary space partitioning of model faces
+# node planes are the (quantized) planes of model faces, as used by the game for backface culling
+# faces crossing a node plane are split
+
+class BSPError(Exception):
+    pass
+
+class BSPBuilder(object):
+    # mesh: see geometry.py
+    # quantizer: vertex encoding (see geometry.VertexQuantizer)
+    # candidates: max. number of splitting planes tested per node
+    # normal_error: max. angle between a face normal and its shared normal (degrees, see geometry.NormalPalette)
+    # max_splits: max. number of face splits (None: no limit)
+    def __init__(self, mesh, quantizer, normal_error=1.0, candidates=16, max_splits=None):
+        self.mesh = mesh
+        self.quantizer = quantizer
+        self.candidates = candidates
+        self.max_splits = max_splits
+        # distance below which a vertex is on the plane:
+        # vertex quantization (half step, 1/256 at least) + plane tilt (shared normal, 1/128 normal quantization)
+        # times the distance to the plane origin
+        self.eps = max(quantizer.scale/2, 1/256)
+        self.tilt = np.sin(np.radians(normal_error)) + np.sqrt(3)/256
+        # work on quantized positions/normals (same values as the game)
+        self.verts = [tuple(v) for v in quantizer.snap(mesh.verts).tolist()]
+        self.normals = dequantize_doubles(quantize_doubles(mesh.normals))
+        self.depth = 0
+        self.nodes = 0
+        self.splits = 0
+
+    def add_vertex(self, v):
+        self.verts.append(self.quantizer.snap_point(v))
+        return len(self.verts) - 1
+
+    # (normal, distance, origin)
+    def plane(self, poly):
+        n = self.normals[poly.src]
+        p = self.verts[poly.verts[0]]
+        return n, float(np.dot(n, p)), p
+
+    # signed distances to plane, with on plane tolerance
+    def distances(self, vids, plane):
+        (nx,ny,nz), d, (px,py,pz) = plane
+        dists, tols = [], []
+        for x,y,z in (self.verts[vi] for vi in vids):
+            dists.append(nx*x+ny*y+nz*z-d)
+            tols.append(self.eps + self.tilt*((x-px)**2+(y-py)**2+(z-pz)**2)**0.5)
+        return dists, tols
+
+    # (in front, behind) flags
+    def side(self, vids, plane):
+        dists, tols = self.distances(vids, plane)
+        return any(di>ti for di,ti in zip(dists,tols)), any(di<-ti for di,ti in zip(dists,tols))
+
+    # split convex polygon, returns front and back vertex loops
+    def clip(self, vids, plane):
+        dists, tols = self.distances(vids, plane)
+        front, back = [], []
+        for i, vi in enumerate(vids):
+            j = (i+1) % len(vids)
+            di, dj = dists[i], dists[j]
+            ti, tj = tols[i], tols[j]
+            if di >= -ti:
+                front.append(vi)
+            if di <= ti:
+                back.append(vi)
+            # edge crossing the plane
+            if (di>ti and dj<-tj) or (di<-ti and dj>tj):
+                t = di / (di - dj)
+                a, b = self.verts[vi], self.verts[vids[j]]
+                vk = self.add_vertex([a[k] + t*(b[k]-a[k]) for k in range(3)])
+                front.append(vk)
+                back.append(vk)
+        return front, back
+
+    # split face and its decals
+    def split(self, poly, plane):
+        self.splits += 1
+        if self.max_splits is not None and self.splits > self.max_splits:
+            raise BSPError("Too many face splits (>{})".format(self.max_splits))
+        front, back = self.clip(poly.verts, plane)
+        front, back = dotdict(verts=front, src=poly.src, decals=[]), dotdict(verts=back, src=poly.src, decals=[])
+        for decal in poly.decals:
+            in_front, behind = self.side(decal.verts, plane)
+            if in_front and behind:
+                f, b = self.clip(decal.verts, plane)
+                front.decals.append(dotdict(verts=f, src=decal.src))
+                back.decals.append(dotdict(verts=b, src=decal.src))
+            elif behind:
+                back.decals.append(decal)
+            else:
+                front.decals.append(decal)
+        return front, back
+
+    # pick splitting face: least splits, then most balanced
+    def choose(self, polys):
+        candidates = polys[::max(1, len(polys)//self.candidates)][:self.candidates]
+        planes = [self.plane(poly) for poly in candidates]
+        n = np.array([n for n,_,_ in planes])
+        d = np.array([d for _,d,_ in planes])
+        p = np.array([p for _,_,p in planes])
+        # distances of all vertices to all candidate planes
+        vids = [vi for poly in polys for vi in poly.verts]
+        starts = np.cumsum([0] + [len(poly.verts) for poly in polys[:-1]])
+        verts = np.array([self.verts[vi] for vi in vids])
+        dists = verts @ n.T - d
+        tols = self.eps + self.tilt*np.linalg.norm(verts[:,None,:] - p[None,:,:], axis=2)
+        in_front = np.logical_or.reduceat(dists>tols, starts, axis=0)
+        behind = np.logical_or.reduceat(dists<-tols, starts, axis=0)
+        splits = np.sum(in_front & behind, axis=0)
+        balance = np.abs(np.sum(in_front & ~behind, axis=0) - np.sum(behind & ~in_front, axis=0))
+        return candidates[int(np.argmin(8*splits + balance))]
+
+    # iterative (tree depth is about the number of faces on convex meshes)
+    def build(self, polys):
+        root = dotdict(faces=None, front=None, back=None)
+        stack = [(root, polys, 1)]
+        while stack:
+            node, polys, depth = stack.pop()
+            self.nodes += 1
+            self.depth = max(self.depth, depth)
+            splitter = self.choose(polys)
+            plane = self.plane(splitter)
+            # splitter is always the first face of a node
+            node.faces = [splitter]
+            front, back = [], []
+            for poly in polys:
+                if poly is splitter:
+                    continue
+                in_front, behind = self.side(poly.verts, plane)
+                if in_front and behind:
+                    f, b = self.split(poly, plane)
+                    front.append(f)
+                    back.append(b)
+                elif in_front:
+                    front.append(poly)
+                elif behind:
+                    back.append(poly)
+                else:
+                    node.faces.append(poly)
+            # front subtree first (pre-order)
+            if back:
+                node.back = dotdict(faces=None, front=None, back=None)
+                stack.append((node.back, back, depth+1))
+            if front:
+                node.front = dotdict(faces=None, front=None, back=None)
+                stack.append((node.front, front, depth+1))
+        return root
+
+# split convex polygon into quads (+ 1 triangle)
+def fan(vids):
+    pieces = []
+    i = 1
+    while len(vids)-i >= 3:
+        pieces.append([vids[0]] + vids[i:i+3])
+        i += 2
+    if len(vids)-i == 2:
+        pieces.append([vids[0]] + vids[i:i+2])
+    return pieces
+
+# builds a BSP tree of the given faces (in/out, see export_layer)
+# returns a new mesh with faces in tree order, the new polygons, decals, frames,
+# the tree nodes in pre-order: (face count, children flags: 1=front, 2=back) and build stats
+# normal_error: max. angle between a face normal and its shared normal (degrees)
+# max_splits: raises BSPError above this number of splits (default: 4x number of faces)
+def build_bsp(mesh, polygons, decal_faces_by_parent, frame_by_face, quantizer, normal_error=1.0, candidates=16, max_splits=None):
+    builder = BSPBuilder(mesh, quantizer, normal_error=normal_error, candidates=candidates, max_splits=4*len(polygons) if max_splits is None else max_splits)
+    polys = [dotdict(
+        verts=face_verts(mesh, fi).tolist(),
+        src=fi,
+        decals=[dotdict(verts=face_verts(mesh, di).tolist(), src=di) for di in decal_faces_by_parent.get(fi, [])]) for fi in polygons]
+    root = polys and builder.build(polys)
+
+    # flatten tree + new faces
+    loops, srcs, out_polygons, out_decals, nodes = [], [], [], {}, []
+    def add_face(vids, src):
+        loops.append(vids)
+        srcs.append(src)
+        return len(loops) - 1
+    # pre-order (iterative)
+    stack = root and [root] or []
+    while stack:
+        node = stack.pop()
+        count = 0
+        for poly in node.faces:
+            for vids in fan(poly.verts):
+                fi = add_face(vids, poly.src)
+                out_polygons.append(fi)
+                count += 1
+            # decals are drawn after the last piece
+            if poly.decals:
+                out_decals[fi] = [add_face(vids, decal.src) for decal in poly.decals for vids in fan(decal.verts)]
+        nodes.append([count, (node.front and 1 or 0) | (node.back and 2 or 0)])
+        if node.back:
+            stack.append(node.back)
+        if node.front:
+            stack.append(node.front)
+
+    srcs = np.array(srcs, dtype=np.int32)
+    out = dotdict(mesh)
+    out.verts = np.array(builder.verts, dtype=np.float64).reshape((-1,3))
+    out.loop_vert = np.array([vi for vids in loops for vi in vids], dtype=np.int32)
+    out.loop_total = np.array([len(vids) for vids in loops], dtype=np.int32)
+    out.loop_start = (np.cumsum(out.loop_total) - out.loop_total).astype(np.int32)
+    out.material = mesh.material[srcs]
+    out.normals = mesh.normals[srcs]
+    stats = dotdict(depth=builder.depth, nodes=builder.nodes, splits=builder.splits, faces=len(polygons), bsp_faces=len(out_polygons))
+    return out, out_polygons, out_decals, frame_by_face[srcs], nodes, stats
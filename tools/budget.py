@@ -0,0 +1,138 @@
+import json
+import logging
+from lzs import Codec, ByteCodec
+from model_reader import parse_model
+
+# archive byte budget: raw and compressed bytes per model, lod, section and field kind
+# raw bytes come from the model reader (same layout as game.p8 unpack_model)
+# compressed bytes: cost of each codec token spread over the source bytes it encodes
+
+# compressed cost (bits) of each source byte
+def byte_costs(b, codec, codec_params=None):
+    codec_params = codec_params or {}
+    costs = [0.0]*len(b)
+    if codec=="lzs":
+        cc = Codec(**codec_params)
+        refsize = 1 + cc.b_off + cc.b_len
+        pos = 0
+        for c in cc.schedule(b):
+            if type(c) is tuple:
+                _, l = c
+                for i in range(pos, pos+l):
+                    costs[i] = refsize/l
+                pos += l
+            else:
+                costs[pos] = 9
+                pos += 1
+        # codec header (b_off, b_len, M) + padding of last byte
+        extra = 8*((10 + int(round(sum(costs))) + 7)//8) - sum(costs)
+    elif codec=="lzb":
+        bc = ByteCodec(**codec_params)
+        pos = 0
+        for lits, offset, l in bc.schedule(b):
+            nlits = len(lits)
+            code = l and l - bc.M + 1 or 0
+            # token + length extensions + offset
+            overhead = 1 + (nlits>=15 and (nlits-15)//255 + 1 or 0) + (l and (bc.wide and 2 or 1) + (code>=15 and (code-15)//255 + 1 or 0) or 0)
+            for i in range(pos, pos+nlits):
+                costs[i] = 8
+            # overhead is paid by the match (or the literals of the last sequence)
+            span = l and range(pos+nlits, pos+nlits+l) or range(pos, pos+nlits)
+            for i in span:
+                costs[i] += 8*overhead/len(span)
+            pos += nlits + l
+        # window size byte
+        extra = 8
+    else:
+        costs = [8.0]*len(b)
+        extra = 0
+    return costs, extra
+
+# budget of a model asset: raw/compressed bytes per (section, field kind)
+# codec, codec_params: as picked by the build (see make.encode_asset, make.encode_assets_best)
+def asset_budget(name, data, codec, codec_params):
+    _, r = parse_model(data)
+    costs, extra = byte_costs(data, codec, codec_params)
+    rows = {}
+    for start, size, section, kind in r.fields:
+        row = rows.setdefault((section, kind), dict(section=section, field=kind, count=0, raw=0, compressed=0.0))
+        row["count"] += 1
+        row["raw"] += size
+        row["compressed"] += sum(costs[start:start+size])/8
+    return dict(
+        name=name,
+        codec=codec,
+        codec_params=codec_params,
+        raw=len(data),
+        compressed=int(round((sum(costs) + extra)/8)),
+        header=extra/8,
+        rows=sorted(rows.values(), key=lambda row: (row["section"], row["field"])))
+
+# assets: list of (name, model bytes)
+# choices: name -> (codec, codec parameters) of each asset
+# archive_len, index_len, cart_len: archive layout (optional, see make.layout_archive)
+def archive_budget(assets, choices, archive_len=None, index_len=None, cart_len=None):
+    report = dict(assets=[asset_budget(name, data, *choices[name]) for name, data in assets])
+    if archive_len is not None:
+        report["archive"] = dict(
+            bytes=archive_len,
+            index=index_len,
+            padding=archive_len - index_len - sum(asset["compressed"] for asset in report["assets"]),
+            carts=(archive_len + cart_len - 1)//cart_len)
+    return report
+
+# (asset, section) -> [raw, compressed] totals
+def section_totals(report):
+    totals = {}
+    for asset in report["assets"]:
+        for row in asset["rows"]:
+            key = (asset["name"], row["section"])
+            total = totals.setdefault(key, [0, 0.0])
+            total[0] += row["raw"]
+            total[1] += row["compressed"]
+    return totals
+
+def log_report(report):
+    logging.info("{:<12} {:<24} {:>8} {:>10} {:>8}  {}".format("asset", "section", "raw", "compressed", "share", "2-byte variants"))
+    for asset in report["assets"]:
+        variants = {}
+        for row in asset["rows"]:
+            if row["field"].startswith("variant"):
+                v = variants.setdefault(row["section"], [0, 0])
+                v[row["field"]=="variant2" and 1 or 0] += row["count"]
+        totals = {}
+        for row in asset["rows"]:
+            total = totals.setdefault(row["section"], [0, 0.0])
+            total[0] += row["raw"]
+            total[1] += row["compressed"]
+        for section, (raw, compressed) in sorted(totals.items()):
+            v1, v2 = variants.get(section, [0, 0])
+            logging.info("{:<12} {:<24} {:>8} {:>10.1f} {:>7.1f}%  {}".format(
+                asset["name"], section, raw, compressed, 100*compressed/max(asset["compressed"], 1), v1+v2 and "{}/{} ({:.0f}%)".format(v2, v1+v2, 100*v2/(v1+v2)) or ""))
+        logging.info("{:<12} {:<24} {:>8} {:>10} {:>7}   codec: {} {}".format(asset["name"], "total", asset["raw"], asset["compressed"], "", asset["codec"], asset["codec_params"] or ""))
+    archive = report.get("archive")
+    if archive:
+        logging.info("archive: {} bytes (index: {} padding: {}) carts: {}".format(archive["bytes"], archive["index"], archive["padding"], archive["carts"]))
+
+# compare with a saved report: logs per section changes (largest first), returns total compressed delta
+def compare_reports(report, baseline):
+    current, previous = section_totals(report), section_totals(baseline)
+    deltas = []
+    for key in set(current) | set(previous):
+        raw, compressed = current.get(key, [0, 0.0])
+        old_raw, old_compressed = previous.get(key, [0, 0.0])
+        if raw != old_raw or abs(compressed - old_compressed) >= 0.5:
+            deltas.append((compressed - old_compressed, raw - old_raw, key))
+    for compressed, raw, (name, section) in sorted(deltas, key=lambda d: -abs(d[0])):
+        logging.info("{:<12} {:<24} raw: {:>+7} compressed: {:>+9.1f}".format(name, section, raw, compressed))
+    total = sum(asset["compressed"] for asset in report["assets"]) - sum(asset["compressed"] for asset in baseline["assets"])
+    logging.info("Total compressed change: {:+} bytes (vs. baseline)".format(total))
+    return total
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+def load_report(path):
+    with open(path, 'r') as f:
+        return json.load(f)
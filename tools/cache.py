@@ -0,0 +1,61 @@
+import os
+import hashlib
+import tempfile
+import logging
+
+# content-addressed file cache
+# entries are files named after the hash of their inputs
+# least recently used entries are evicted when cache exceeds max_size bytes
+class ExportCache(object):
+  def __init__(self, path, max_size=64*1024*1024):
+    self.path = path
+    self.max_size = max_size
+    os.makedirs(path, exist_ok=True)
+
+  # hash of the given byte strings (order matters)
+  def key(self, *parts):
+    h = hashlib.sha256()
+    for part in parts:
+      # length prefix: no ambiguity between ("ab","c") and ("a","bc")
+      h.update(len(part).to_bytes(8, 'little'))
+      h.update(part)
+    return h.hexdigest()
+
+  def get(self, key):
+    path = os.path.join(self.path, key)
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+    except FileNotFoundError:
+      return None
+    # mark as recently used
+    os.utime(path)
+    return data
+
+  def put(self, key, data):
+    # write + rename: no partial entries
+    fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.replace(tmp, os.path.join(self.path, key))
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for name in os.listdir(self.path):
+      if name.endswith(".tmp"):
+        continue
+      st = os.stat(os.path.join(self.path, name))
+      entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    # oldest first
+    for _, size, name in sorted(entries):
+      if total <= self.max_size:
+        break
+      logging.debug("Cache - evicting: {}".format(name))
+      os.remove(os.path.join(self.path, name))
+      total -= size
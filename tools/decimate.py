@@ -0,0 +1,271 @@
+import math
+import heapq
+import numpy as np
+from dotdict import dotdict
+from geometry import face_verts, quantize_doubles
+
+# mesh simplification (edge collapse, quadric error metric)
+# works on quantized positions: collapsed vertices are snapped to the archive grid
+# and errors are measured on snapped positions (what the game will draw)
+# note: plain python math - numpy is slower on 3d vectors
+
+# weight of planes preserving open borders and material borders
+BORDER_WEIGHT = 100
+
+def v_sub(a, b):
+    return (a[0]-b[0], a[1]-b[1], a[2]-b[2])
+
+def v_dot(a, b):
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+def v_cross(a, b):
+    return (a[1]*b[2]-a[2]*b[1], a[2]*b[0]-a[0]*b[2], a[0]*b[1]-a[1]*b[0])
+
+def v_normz(a):
+    l = math.sqrt(v_dot(a, a))
+    return l>0 and (a[0]/l, a[1]/l, a[2]/l) or (0, 0, 0)
+
+def tri_normal(a, b, c):
+    return v_normz(v_cross(v_sub(b, a), v_sub(c, a)))
+
+# symmetric 4x4 matrix of plane n.p+d=0: (aa, ab, ac, ad, bb, bc, bd, cc, cd, dd)
+def plane_quadric(n, p, weight=1):
+    a, b, c = n
+    d = -v_dot(n, p)
+    return tuple(weight*x for x in (a*a, a*b, a*c, a*d, b*b, b*c, b*d, c*c, c*d, d*d))
+
+def q_add(q0, q1):
+    return tuple(x+y for x,y in zip(q0, q1))
+
+def q_error(q, p):
+    aa, ab, ac, ad, bb, bc, bd, cc, cd, dd = q
+    x, y, z = p
+    return aa*x*x + 2*ab*x*y + 2*ac*x*z + 2*ad*x + bb*y*y + 2*bc*y*z + 2*bd*y + cc*z*z + 2*cd*z + dd
+
+# position minimizing the quadric error (None if ill-conditioned)
+def q_optimum(q):
+    aa, ab, ac, ad, bb, bc, bd, cc, cd, dd = q
+    det = aa*(bb*cc-bc*bc) - ab*(ab*cc-bc*ac) + ac*(ab*bc-bb*ac)
+    if abs(det) < 1e-9:
+        return None
+    x = (-ad*(bb*cc-bc*bc) + ab*(bd*cc-bc*cd) - ac*(bd*bc-bb*cd)) / det
+    y = (aa*(-bd*cc+cd*bc) + ad*(ab*cc-bc*ac) + ac*(-ab*cd+bd*ac)) / det
+    z = (aa*(-bb*cd+bc*bd) - ab*(-ab*cd+bd*ac) - ad*(ab*bc-bb*ac)) / det
+    return (x, y, z)
+
+class Decimator(object):
+    # mesh: see geometry.py
+    # locked: vertices that must not move (used by animation frames/decals)
+    # quantizer: vertex encoding (see geometry.VertexQuantizer)
+    def __init__(self, mesh, locked, quantizer):
+        self.snap = quantizer.snap_point
+        # collapses below that error are not visible once quantized
+        self.free_error = (quantizer.scale/2)**2
+        self.pos = [self.snap(p) for p in mesh.verts.tolist()]
+        self.locked = locked
+        self.dead = [False]*len(self.pos)
+        self.version = [0]*len(self.pos)
+        self.tris = []
+        self.tri_mat = []
+        self.tri_alive = []
+        self.vert_tris = [set() for _ in range(len(self.pos))]
+        # faces left untouched (all vertices locked)
+        self.kept = []
+        for fi in range(len(mesh.loop_start)):
+            verts = face_verts(mesh, fi).tolist()
+            if all(self.locked[vi] for vi in verts):
+                self.kept.append(fi)
+                continue
+            # fan triangulation
+            for i in range(1, len(verts)-1):
+                self.add_tri([verts[0], verts[i], verts[i+1]], int(mesh.material[fi]))
+        self.quadrics()
+
+    def add_tri(self, tri, mat):
+        ti = len(self.tris)
+        self.tris.append(tri)
+        self.tri_mat.append(mat)
+        self.tri_alive.append(True)
+        for vi in tri:
+            self.vert_tris[vi].add(ti)
+
+    def remove_tri(self, ti):
+        self.tri_alive[ti] = False
+        for vi in self.tris[ti]:
+            self.vert_tris[vi].discard(ti)
+
+    def alive(self):
+        return sum(self.tri_alive)
+
+    def normal(self, ti):
+        return tri_normal(*(self.pos[vi] for vi in self.tris[ti]))
+
+    def quadrics(self):
+        self.q = [(0,)*10 for _ in range(len(self.pos))]
+        edges = {}
+        for ti, tri in enumerate(self.tris):
+            q = plane_quadric(self.normal(ti), self.pos[tri[0]])
+            for vi in tri:
+                self.q[vi] = q_add(self.q[vi], q)
+            for i in range(3):
+                edge = tri[i], tri[(i+1)%3]
+                edges.setdefault((min(edge), max(edge)), []).append((ti, edge))
+        # open borders and material changes: plane orthogonal to face along edge
+        for faces in edges.values():
+            if len(faces)==1 or len(set(self.tri_mat[ti] for ti,_ in faces))>1:
+                for ti, (u, v) in faces:
+                    pu, pv = self.pos[u], self.pos[v]
+                    n = v_normz(v_cross(v_sub(pv, pu), self.normal(ti)))
+                    q = plane_quadric(n, pu, BORDER_WEIGHT)
+                    self.q[u] = q_add(self.q[u], q)
+                    self.q[v] = q_add(self.q[v], q)
+
+    # best collapse of edge u,v: (cost, removed vertex, kept vertex, position) or None
+    def collapse_cost(self, u, v):
+        if self.locked[u] and self.locked[v]:
+            return None
+        q = q_add(self.q[u], self.q[v])
+        pu, pv = self.pos[u], self.pos[v]
+        if self.locked[u]:
+            targets = [(v, u, pu)]
+        elif self.locked[v]:
+            targets = [(u, v, pv)]
+        else:
+            mid = self.snap(((pu[0]+pv[0])/2, (pu[1]+pv[1])/2, (pu[2]+pv[2])/2))
+            targets = [(u, v, pu), (u, v, pv), (u, v, mid)]
+            p = q_optimum(q)
+            # reject far away solutions (nearly flat area)
+            if p:
+                dp, dm = v_sub(p, mid), v_sub(pv, pu)
+                if v_dot(dp, dp) <= v_dot(dm, dm):
+                    targets.append((u, v, self.snap(p)))
+        best = None
+        for removed, kept, p in targets:
+            cost = q_error(q, p)
+            if (best is None or cost < best[0]) and self.valid(removed, kept, p):
+                best = (cost, removed, kept, p)
+        return best
+
+    # collapse must not flip or degenerate any remaining triangle
+    def valid(self, removed, kept, p):
+        for vi in (removed, kept):
+            for ti in self.vert_tris[vi]:
+                tri = self.tris[ti]
+                if removed in tri and kept in tri:
+                    continue
+                n0 = self.normal(ti)
+                n1 = tri_normal(*(p if vj==vi else self.pos[vj] for vj in tri))
+                if v_dot(n0, n1)<0.2:
+                    return False
+        return True
+
+    def push_edges(self, heap, vi):
+        for vj in set(vj for ti in self.vert_tris[vi] for vj in self.tris[ti]):
+            if vj == vi:
+                continue
+            best = self.collapse_cost(vi, vj)
+            if best:
+                cost, removed, kept, p = best
+                heapq.heappush(heap, (cost, removed, kept, self.version[removed], self.version[kept], p))
+
+    def collapse(self, removed, kept, p):
+        for ti in list(self.vert_tris[removed]):
+            tri = self.tris[ti]
+            if kept in tri:
+                self.remove_tri(ti)
+            else:
+                tri[tri.index(removed)] = kept
+                self.vert_tris[kept].add(ti)
+        self.vert_tris[removed] = set()
+        self.q[kept] = q_add(self.q[kept], self.q[removed])
+        self.pos[kept] = p
+        self.dead[removed] = True
+        self.version[kept] += 1
+        self.version[removed] += 1
+
+    # collapse edges until target number of triangles is reached
+    # errors below the quantization step are always collapsed
+    # max_error: max. geometric error (None: no limit)
+    def run(self, target, max_error=None):
+        heap = []
+        for vi in range(len(self.pos)):
+            self.push_edges(heap, vi)
+        count = self.alive()
+        while heap:
+            cost, removed, kept, ver_removed, ver_kept, p = heapq.heappop(heap)
+            if self.dead[removed] or self.dead[kept] or self.version[removed]!=ver_removed or self.version[kept]!=ver_kept:
+                continue
+            if cost > self.free_error and count <= target:
+                break
+            if max_error is not None and cost > max_error**2:
+                break
+            count -= len(self.vert_tris[removed] & self.vert_tris[kept])
+            self.collapse(removed, kept, p)
+            self.push_edges(heap, kept)
+
+    # live triangles, merged into quads when possible: [(verts, material)]
+    def faces(self):
+        tris = [ti for ti, alive in enumerate(self.tri_alive) if alive]
+        normals = {ti: tuple(quantize_doubles(self.normal(ti)).tolist()) for ti in tris}
+        by_edge = {}
+        for ti in tris:
+            tri = self.tris[ti]
+            for i in range(3):
+                by_edge[(tri[i], tri[(i+1)%3])] = ti
+        merged = set()
+        faces = []
+        for ti in tris:
+            if ti in merged:
+                continue
+            merged.add(ti)
+            tri = self.tris[ti]
+            face = tri
+            for i in range(3):
+                x, y, z = tri[i], tri[(i+1)%3], tri[(i+2)%3]
+                tj = by_edge.get((y, x))
+                if tj is None or tj in merged or self.tri_mat[tj]!=self.tri_mat[ti] or normals[tj]!=normals[ti]:
+                    continue
+                w = [vi for vi in self.tris[tj] if vi!=x and vi!=y][0]
+                quad = [x, w, y, z]
+                if self.convex(quad):
+                    face = quad
+                    merged.add(tj)
+                    break
+            faces.append((face, self.tri_mat[ti]))
+        return faces
+
+    def convex(self, quad):
+        p = [self.pos[vi] for vi in quad]
+        n = tri_normal(p[0], p[1], p[2])
+        for i in range(4):
+            a, b, c = p[i], p[(i+1)%4], p[(i+2)%4]
+            if v_dot(v_cross(v_sub(b, a), v_sub(c, b)), n) <= 0:
+                return False
+        return True
+
+# new mesh with approx. ratio x number of triangles
+# vertices used by vertex groups (animation frames, decals...) are not moved
+# max_error: max. collapse error (distance)
+# returns new mesh (same vertices, unused vertices are removed by welding)
+def decimate(mesh, quantizer, ratio=0.5, max_error=None):
+    locked = np.zeros(len(mesh.verts), dtype=bool)
+    locked[mesh.group_vert] = True
+    decimator = Decimator(mesh, locked.tolist(), quantizer)
+    decimator.run(int(ratio*decimator.alive()), max_error=max_error)
+
+    faces = [(face_verts(mesh, fi).tolist(), int(mesh.material[fi]), mesh.normals[fi]) for fi in decimator.kept]
+    for verts, mat in decimator.faces():
+        faces.append((verts, mat, tri_normal(*(decimator.pos[vi] for vi in verts[:3]))))
+
+    out = dotdict(mesh)
+    out.verts = np.array(decimator.pos, dtype=np.float64).reshape((-1,3))
+    out.loop_vert = np.array([vi for verts,_,_ in faces for vi in verts], dtype=np.int32)
+    out.loop_total = np.array([len(verts) for verts,_,_ in faces], dtype=np.int32)
+    out.loop_start = (np.cumsum(out.loop_total) - out.loop_total).astype(np.int32)
+    out.material = np.array([mat for _,mat,_ in faces], dtype=np.int32)
+    out.normals = np.array([n for _,_,n in faces], dtype=np.float64).reshape((-1,3))
+    return out
+
+# number of triangles (quads count for 2)
+def triangle_count(mesh):
+    return int(np.sum(mesh.loop_total - 2))
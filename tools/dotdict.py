@@ -2,3 +2,5 @@
 class dotdict(dict):
     def __getattr__(self, name):
         return self[name]
+    def __setattr__(self, name, value):
+        self[name] = value
@@ -0,0 +1,268 @@
+import re
+import numpy as np
+from dotdict import dotdict
+
+# mesh processing helpers (numpy only - no Blender dependency)
+# a mesh is a dotdict of arrays, as returned by blender_export.extract_mesh:
+# verts, loop_vert, loop_start, loop_total, material, normals, vgroup_names, group_vert, group_index, group_weight
+
+# quantized double (see packer.pack_double) as 16 bits unsigned ints
+def quantize_doubles(a):
+    return np.round(128*np.asarray(a, dtype=np.float64)+16384).astype(np.int64) & 0xffff
+
+def dequantize_doubles(q):
+    return (np.asarray(q, dtype=np.float64)-16384)/128
+
+# vectorized pack_double (array of floats)
+def pack_doubles_array(a):
+    return quantize_doubles(a).astype('>u2').tobytes()
+
+# Convert from Blender format to y-up format (array of vectors)
+def pack_vectors_array(a):
+    return pack_doubles_array(np.asarray(a)[:,[0,2,1]])
+
+# vertex positions: origin + scale x signed 1 or 2 bytes integer (per component)
+# scale is a multiple of 1/65536 (exact 16:16 fixed point value on cart)
+class VertexQuantizer(object):
+    def __init__(self, origin, scale, nbytes):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.scale = scale
+        self.nbytes = nbytes
+        self.qmin, self.qmax = -(1<<(8*nbytes-1)), (1<<(8*nbytes-1))-1
+        self.origin_list = self.origin.tolist()
+
+    # integer coordinates (clamped to range)
+    def encode(self, points):
+        q = np.round((np.asarray(points, dtype=np.float64) - self.origin)/self.scale)
+        return np.clip(q, self.qmin, self.qmax).astype(np.int64)
+
+    def snap(self, points):
+        return self.origin + self.scale*self.encode(points)
+
+    # single point (plain python: faster on 3d vectors)
+    def snap_point(self, p):
+        return tuple(o + self.scale*min(max(round((c-o)/self.scale), self.qmin), self.qmax) for o,c in zip(self.origin_list, p))
+
+    # max. distance between a point (in range) and its quantized position
+    def error(self):
+        return self.scale*np.sqrt(3)/2
+
+    # Convert from Blender format to y-up format
+    def pack(self, points):
+        q = self.encode(points).reshape((-1,3))[:,[0,2,1]]
+        if self.nbytes==1:
+            return (q + 128).astype(np.uint8).tobytes()
+        return (q & 0xffff).astype('>u2').tobytes()
+
+# most compact encoding of points with an error below max_error (per component)
+# origin is on the 1/128 grid (see packer.pack_double)
+def vertex_quantizer(points, max_error=1/32):
+    points = np.asarray(points, dtype=np.float64).reshape((-1,3))
+    if len(points)==0:
+        return VertexQuantizer((0,0,0), 1/128, 2)
+    origin = dequantize_doubles(quantize_doubles((points.min(axis=0) + points.max(axis=0))/2))
+    extent = max(np.max(np.abs(points - origin)), 1/128)
+    for nbytes in (1,2):
+        qmax = (1<<(8*nbytes-1))-1
+        scale = max(np.ceil(65536*extent/qmax)/65536, 1/65536)
+        if scale/2 <= max_error:
+            break
+    return VertexQuantizer(origin, scale, nbytes)
+
+# face vertex indices
+def face_verts(mesh, fi):
+    start = mesh.loop_start[fi]
+    return mesh.loop_vert[start:start+mesh.loop_total[fi]]
+
+# parse vertex group names (once per group)
+# returns a dotdict per group index: frame (animation frame id or None), decal (parent group name or None)
+def parse_groups(vgroup_names):
+    frame_re = re.compile(r"frame:([0-9]+)")
+    decal_re = re.compile(r"decal:(.+)")
+    groups = {}
+    for gi, gname in vgroup_names.items():
+        frame = frame_re.match(gname)
+        decal = decal_re.match(gname)
+        groups[gi] = dotdict(
+            name=gname,
+            frame=frame and int(frame.groups()[0]),
+            decal=decal and decal.groups()[0])
+    return groups
+
+# vertex group bitmask per vertex
+# uses native 64 bits ints when possible, python ints otherwise
+def vertex_group_masks(mesh):
+    nv = len(mesh.verts)
+    ng = max(mesh.vgroup_names.keys(), default=-1) + 1
+    if ng <= 64:
+        masks = np.zeros(nv, dtype=np.uint64)
+        np.bitwise_or.at(masks, mesh.group_vert, np.left_shift(np.uint64(1), mesh.group_index.astype(np.uint64)))
+        return masks
+    masks = np.zeros(nv, dtype=object)
+    for vi, gi in zip(mesh.group_vert.tolist(), mesh.group_index.tolist()):
+        masks[vi] |= 1<<gi
+    return masks
+
+# group index of each face (-1: no group)
+# a face belongs to a group if all its vertices are in that group:
+# face mask = AND of its vertices masks
+def face_groups(mesh):
+    nf = len(mesh.loop_start)
+    face_group = np.full(nf, -1, dtype=np.int32)
+    if nf==0 or len(mesh.group_vert)==0:
+        return face_group
+    masks = vertex_group_masks(mesh)
+    face_masks = np.bitwise_and.reduceat(masks[mesh.loop_vert], mesh.loop_start)
+    for fi in np.flatnonzero(face_masks).tolist():
+        mask = int(face_masks[fi])
+        if mask & (mask-1):
+            names = [mesh.vgroup_names[gi] for gi in range(mask.bit_length()) if mask & (1<<gi)]
+            raise Exception("Face: {} registered in multiple groups: {}".format(fi, names))
+        face_group[fi] = mask.bit_length() - 1
+    return face_group
+
+# resolve animation frames and decals
+# returns frame id per face (-1: none), decal faces per parent face, set of decal faces
+def face_frames_and_decals(mesh, groups, face_group):
+    frame_by_face = np.full(len(face_group), -1, dtype=np.int32)
+    grouped = np.flatnonzero(face_group>=0).tolist()
+    # last face of a group is the decal parent
+    face_by_group = {}
+    for fi in grouped:
+        face_by_group[int(face_group[fi])] = fi
+    group_by_name = {g.name: gi for gi, g in groups.items()}
+
+    decal_faces_by_parent = {}
+    decal_faces = set()
+    for fi in grouped:
+        group = groups[int(face_group[fi])]
+        if group.frame is not None:
+            frame_by_face[fi] = group.frame
+        if group.decal is not None:
+            parent = face_by_group.get(group_by_name.get(group.decal))
+            if parent is not None:
+                decal_faces_by_parent.setdefault(parent, []).append(fi)
+                decal_faces.add(fi)
+    return frame_by_face, decal_faces_by_parent, decal_faces
+
+# merge vertices with the same quantized position and renumber them by first use
+# faces: face indices in export order
+# returns vertices (one per quantized position, in first use order) and old->new vertex index map (-1: unused vertex)
+def weld_vertices(mesh, faces, quantizer):
+    q = quantizer.encode(mesh.verts)
+    _, first_vert, welded = np.unique(q, axis=0, return_index=True, return_inverse=True)
+    welded = welded.reshape(-1)
+    # loop vertices in export order
+    loops = [face_verts(mesh, fi) for fi in faces]
+    used = welded[np.concatenate(loops)] if loops else np.zeros(0, dtype=np.int64)
+    _, first_use = np.unique(used, return_index=True)
+    order = used[np.sort(first_use)]
+    rank = np.full(len(first_vert), -1, dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return mesh.verts[first_vert[order]], rank[welded]
+
+# collision hull optimization
+# normals, dists: face planes (n.p=d, n pointing outside)
+# points: hull mesh vertices (optional) - volume vertices are searched among the planes meeting at each point
+# instead of all plane triples (O(k^3) triples for k planes)
+# coplanar planes are merged, planes not supporting a face of the convex volume (intersection of all half-spaces) are dropped
+# returns kept plane indices and vertices of the convex volume
+def hull_planes(normals, dists, points=None, eps=1/256):
+    normals, dists = np.asarray(normals, dtype=np.float64).reshape((-1,3)), np.asarray(dists, dtype=np.float64)
+    # merge coplanar planes (merged[i]: kept plane of plane i)
+    kept = []
+    merged = np.empty(len(normals), dtype=np.int64)
+    for i in range(len(normals)):
+        same = np.flatnonzero((normals[kept] @ normals[i] > 1-1e-4) & (np.abs(dists[kept] - dists[i]) < eps)) if kept else []
+        if len(same):
+            merged[i] = same[0]
+        else:
+            merged[i] = len(kept)
+            kept.append(i)
+    n, d = normals[kept], dists[kept]
+    # candidate triples of planes
+    if points is None:
+        triples = np.array([(i,j,k) for i in range(len(kept)) for j in range(i+1,len(kept)) for k in range(j+1,len(kept))], dtype=np.int64).reshape((-1,3))
+    else:
+        points = np.asarray(points, dtype=np.float64).reshape((-1,3))
+        triples = set()
+        for start in range(0, len(points), 1024):
+            on_face = np.abs(points[start:start+1024] @ normals.T - dists) <= eps
+            for faces in on_face:
+                planes = sorted(set(merged[faces].tolist()))
+                triples.update((planes[a],planes[b],planes[c]) for a in range(len(planes)) for b in range(a+1,len(planes)) for c in range(b+1,len(planes)))
+        triples = np.array(sorted(triples), dtype=np.int64).reshape((-1,3))
+    # convex volume vertices: intersection of 3 planes, inside all other planes
+    # triples are processed in chunks (inside test is chunk x planes)
+    chunk = max(4096, (1 << 22)//max(len(kept), 1))
+    verts = [np.zeros((0,3))]
+    for start in range(0, len(triples), chunk):
+        a = n[triples[start:start+chunk]]
+        solvable = np.abs(np.linalg.det(a))>1e-6
+        if solvable.any():
+            v = np.linalg.solve(a[solvable], d[triples[start:start+chunk][solvable]][...,None])[...,0]
+            verts.append(v[np.all(v @ n.T - d <= eps, axis=1)])
+    verts = np.concatenate(verts)
+    if len(verts)<4:
+        # not a closed volume
+        return kept, verts
+    # a plane is needed if it has a face (3 non aligned vertices)
+    needed = []
+    for i in range(len(kept)):
+        on_plane = verts[np.abs(verts @ n[i] - d[i]) <= eps]
+        if len(on_plane)>=3 and np.linalg.matrix_rank(on_plane[1:] - on_plane[0], tol=eps)>=2:
+            needed.append(kept[i])
+    return needed, verts
+
+# bounding sphere of points, center snapped to the archive grid
+# radius is rounded up (sphere still contains all points)
+def bounding_sphere(points):
+    points = np.asarray(points, dtype=np.float64).reshape((-1,3))
+    center = dequantize_doubles(quantize_doubles((points.min(axis=0) + points.max(axis=0))/2))
+    radius = np.sqrt(np.max(np.sum((points - center)**2, axis=1)))
+    return center, np.ceil(128*radius)/128
+
+# shared normals (per model)
+# greedy clustering: a normal reuses the first palette entry within max_error degrees
+# palette entries are quantized unit vectors (values stored in the archive)
+class NormalPalette(object):
+    def __init__(self, max_error=1.0):
+        self.min_cos = np.cos(np.radians(max_error))
+        self.normals = []
+        # unit length entries (quantized entries are not), capacity grows by doubling
+        self.units = np.empty((64,3), dtype=np.float64)
+        self.ids = {}
+        self.errors = []
+
+    # palette normal for each normal (new entries are created when needed)
+    # zero length normals (degenerate faces) use the up entry
+    def snap(self, normals):
+        normals = np.asarray(normals, dtype=np.float64).reshape((-1,3))
+        lengths = np.linalg.norm(normals, axis=1)
+        units = np.where(lengths[:,None]>0, normals/np.where(lengths>0, lengths, 1)[:,None], [0,0,1])
+        qs = dequantize_doubles(quantize_doubles(units))
+        keys = [tuple(q) for q in qs.tolist()]
+        out = np.empty_like(normals)
+        ids = np.empty(len(normals), dtype=np.int64)
+        for i, key in enumerate(keys):
+            if key not in self.ids and self.normals:
+                # closest existing entry
+                cos = self.units[:len(self.normals)] @ units[i]
+                best = int(np.argmax(cos))
+                if cos[best] >= self.min_cos:
+                    key = self.normals[best]
+            if key not in self.ids:
+                if len(self.normals)==len(self.units):
+                    self.units = np.concatenate([self.units, np.empty_like(self.units)])
+                self.ids[key] = len(self.normals)
+                self.units[len(self.normals)] = qs[i]/np.linalg.norm(qs[i])
+                self.normals.append(key)
+            out[i] = key
+            ids[i] = self.ids[key]
+        cos = np.einsum('ij,ij->i', units, self.units[ids])
+        self.errors.extend(np.where(lengths>0, np.degrees(np.arccos(np.clip(cos, -1, 1))), 0).tolist())
+        return out
+
+    # palette index of palette normals
+    def indices(self, normals):
+        return [self.ids[tuple(n)] for n in np.asarray(normals, dtype=np.float64).reshape((-1,3)).tolist()]
@@ -0,0 +1,79 @@
+import os
+import time
+import asyncio
+import logging
+from asyncio.subprocess import PIPE
+from dotdict import dotdict
+from timeline import timeline
+
+# bounded concurrent subprocess runner
+# a job is a dotdict: name, args (command line), cwd (optional), log_stdout (stdout lines logged at INFO level, DEBUG otherwise)
+
+class JobError(Exception):
+    pass
+
+def make_job(name, args, cwd=None, log_stdout=False):
+    return dotdict(name=name, args=args, cwd=cwd, log_stdout=log_stdout)
+
+async def _stream(reader, name, lines, log):
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        lines.append(line)
+        if log:
+            log("[{}] {}".format(name, line.decode(errors='replace').rstrip()))
+
+async def _run_job(job, semaphore, timeout, check_stderr):
+    async with semaphore:
+        logging.debug("[{}] starting: {}".format(job.name, " ".join(job.args)))
+        start = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(*job.args, stdout=PIPE, stderr=PIPE, cwd=job.cwd)
+        out, err = [], []
+        try:
+            # stderr is reported as it comes
+            await asyncio.wait_for(asyncio.gather(
+                _stream(proc.stdout, job.name, out, job.log_stdout and logging.info or logging.debug),
+                _stream(proc.stderr, job.name, err, logging.warning),
+                proc.wait()), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise JobError("[{}] timed out after {}s".format(job.name, timeout))
+        except asyncio.CancelledError:
+            # sibling job failed
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        out, err = b"".join(out), b"".join(err)
+        timeline.add_process(job.name, start, time.perf_counter(), args=" ".join(job.args), exit_code=proc.returncode)
+        logging.debug("[{}] exit code: {}".format(job.name, proc.returncode))
+        if proc.returncode != 0 or (check_stderr and err):
+            raise JobError("[{}] failed (exit code: {}). Exception: {}".format(job.name, proc.returncode, err))
+        return proc.returncode, out, err
+
+async def _run_jobs(jobs, limit, timeout, check_stderr):
+    semaphore = asyncio.Semaphore(limit)
+    tasks = [asyncio.ensure_future(_run_job(job, semaphore, timeout, check_stderr)) for job in jobs]
+    try:
+        # first failure cancels all other jobs
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception():
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    # results in job order (not completion order)
+    return [task.result() for task in tasks]
+
+# run jobs with at most limit processes at once
+# timeout: max. duration of a single job in seconds (None: no limit)
+# check_stderr: any output on stderr is an error
+# returns (exitcode, stdout, stderr) for each job, in jobs order
+def run_jobs(jobs, limit=None, timeout=None, check_stderr=True):
+    if not jobs:
+        return []
+    return asyncio.run(_run_jobs(jobs, limit or os.cpu_count() or 1, timeout, check_stderr))
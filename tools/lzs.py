@@ -5,33 +5,182 @@ import array
 # LZS compression
 # credits: https://www.excamera.com/sphinx/article-compression.html
 
-def prefix(s1, s2): 
-  """ Return the length of the common prefix of s1 and s2 """
-  sz = len(s2)
-  for i in range(sz): 
-    if s1[i % len(s1)] != s2[i]: 
-      return i 
-  return sz 
-  
-class Bitstream(object): 
+# codec ids (first byte of the archive)
+CODEC_RAW = 0
+CODEC_LZS = 1
+CODEC_LZB = 2
+
+# largest LZS window (b_off) lzs.lua can decode at a reasonable cost:
+# PICO-8 numbers are 16:16 fixed point (1<<15 wraps to -32768) and
+# history is a table trimmed with deli(history,1) (shifts the whole window for each byte)
+LZS_MAX_B_OFF = 13
+
+class MatchFinder(object):
+  """ Hash chains over a sliding window: for each key of min_len bytes, 
+      head[key] is the most recent position and prev[pos] the previous one """
+  def __init__(self, blk, window, min_len, max_len, max_chain=256):
+    self.blk = blk
+    self.window = window
+    self.min_len = min_len
+    self.max_len = max_len
+    self.max_chain = max_chain
+    self.head = {}
+    self.prev = [-1] * len(blk)
+
+  def key(self, pos):
+    return self.blk[pos:pos+self.min_len]
+
+  def insert(self, pos):
+    """ Register pos without searching (e.g. bytes covered by a match) """
+    if pos + self.min_len > len(self.blk):
+      return
+    k = self.key(pos)
+    self.prev[pos] = self.head.get(k, -1)
+    self.head[k] = pos
+
+  def match_len(self, p, pos, limit):
+    """ Length of the match between p and pos (overlap allowed), up to limit """
+    blk = self.blk
+    # keys are equal: the first min_len bytes always match
+    l = self.min_len
+    # compare 8 bytes at a time before falling back to single bytes
+    while l + 8 <= limit and blk[p+l:p+l+8] == blk[pos+l:pos+l+8]:
+      l += 8
+    while l < limit and blk[p+l] == blk[pos+l]:
+      l += 1
+    return l
+
+  def find(self, pos):
+    """ Return (length, position) of the longest match for pos and register pos """
+    blk = self.blk
+    bestlen, bestpos = 0, 0
+    if pos + self.min_len <= len(blk):
+      limit = min(self.max_len, len(blk) - pos)
+      oldest = max(pos - self.window, 0)
+      p = self.head.get(self.key(pos), -1)
+      chain = self.max_chain
+      while p >= oldest and chain > 0:
+        # skip candidates that cannot beat the current best (nearest wins on ties)
+        if bestlen == 0 or blk[p+bestlen] == blk[pos+bestlen]:
+          l = self.match_len(p, pos, limit)
+          if l > bestlen:
+            bestlen, bestpos = l, p
+            if l == limit:
+              break
+        p = self.prev[p]
+        chain -= 1
+    self.insert(pos)
+    return (bestlen, bestpos)
+
+  def find_all(self, nice_len=64):
+    """ Return the longest match at every position. A match longer than nice_len
+        is carried over to the next position (shifted by one) without searching """
+    matches = []
+    (l, p) = (0, 0)
+    for pos in range(len(self.blk)):
+      if l > nice_len:
+        (l, p) = (l - 1, p + 1)
+        self.insert(pos)
+      else:
+        (l, p) = self.find(pos)
+      matches.append((l, p))
+    return matches
+
+# bit-reversal table: streams are packed MSB-first and reversed once
+# to get the LSB-first byte layout expected by lzs.lua get1()
+REVERSE_BITS = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+class BitWriter(object): 
+  """ Accumulates bits in an integer and flushes whole bytes into a bytearray """
   def __init__(self): 
-    self.b = []
+    self.buf = bytearray()
+    self.acc = 0
+    self.n = 0
   def append(self, sz, v): 
     assert 0 <= v 
     assert v < (1 << sz) 
-    for i in range(sz): 
-      self.b.append(1 & (v >> (sz - 1 - i)))
+    self.acc = (self.acc << sz) | v
+    self.n += sz
+    if self.n >= 32:
+      k = self.n >> 3
+      self.n &= 7
+      self.buf += (self.acc >> self.n).to_bytes(k, 'big')
+      self.acc &= (1 << self.n) - 1
+  def __len__(self):
+    """ Size in bytes (including the partial byte) """
+    return len(self.buf) + ((self.n + 7) >> 3)
+  def tobytes(self):
+    bb = bytearray(self.buf)
+    if self.n:
+      # pad last byte with zeros
+      k = (self.n + 7) >> 3
+      bb += (self.acc << (8 * k - self.n)).to_bytes(k, 'big')
+    return bytes(bb.translate(REVERSE_BITS))
   def toarray(self): 
-    bb = [0] * int((len(self.b) + 7) / 8) 
-    for i,b in enumerate(self.b): 
-      if b: 
-        bb[int(i / 8)] |= (1 << (i & 7)); 
-    return array.array('B', bb) 
+    return array.array('B', self.tobytes()) 
+
+class BitReader(object):
+  """ Reads bits written by BitWriter (same order as lzs.lua get1/getn) """
+  def __init__(self, data):
+    self.buf = bytes(data).translate(REVERSE_BITS)
+    self.pos = 0
+    self.acc = 0
+    self.n = 0
+  def read(self, sz):
+    while self.n < sz:
+      if self.pos >= len(self.buf):
+        raise EOFError("Bitstream exhausted")
+      chunk = self.buf[self.pos:self.pos+8]
+      self.pos += len(chunk)
+      self.acc = (self.acc << (8 * len(chunk))) | int.from_bytes(chunk, 'big')
+      self.n += 8 * len(chunk)
+    self.n -= sz
+    v = self.acc >> self.n
+    self.acc &= (1 << self.n) - 1
+    return v
+  def tell(self):
+    """ Number of bits consumed """
+    return 8 * self.pos - self.n
+
+class RangeMin(object):
+  """ Segment tree: point updates and min over [lo, hi] in O(log n) """
+  def __init__(self, n, default):
+    self.size = 1
+    while self.size < n:
+      self.size <<= 1
+    self.default = default
+    self.tree = [default] * (2 * self.size)
+  def update(self, i, v):
+    tree = self.tree
+    i += self.size
+    tree[i] = v
+    i >>= 1
+    while i:
+      a, b = tree[2*i], tree[2*i+1]
+      tree[i] = a < b and a or b
+      i >>= 1
+  def query(self, lo, hi):
+    tree = self.tree
+    r = self.default
+    lo += self.size
+    hi += self.size + 1
+    while lo < hi:
+      if lo & 1:
+        if tree[lo] < r: r = tree[lo]
+        lo += 1
+      if hi & 1:
+        hi -= 1
+        if tree[hi] < r: r = tree[hi]
+      lo >>= 1
+      hi >>= 1
+    return r
 
 class Codec(object): 
-  def __init__(self, b_off, b_len):
+  def __init__(self, b_off, b_len, optimal=False):
     self.b_off = b_off
     self.b_len = b_len
+    # optimal = True: minimum-bit parse, greedy longest match otherwise
+    self.optimal = optimal
     self.history = 2 ** b_off 
     refsize = (1 + self.b_off + self.b_len) 
     # bits needed for a backreference
@@ -44,36 +193,72 @@ class Codec(object):
     # print "M", self.M # e.g. M 2, b_len 4, so: 0->2, 15->17 
     self.maxlen = self.M + (2**self.b_len) - 1 
   
-  def compress(self, blk): 
-    lempel = {} 
-    sched = []
+  def schedule(self, blk):
+    """ Yield literals (int) and back references (offset, length) """
+    if self.optimal:
+      return self.optimal_schedule(blk)
+    return self.greedy_schedule(blk)
+  def greedy_schedule(self, blk):
+    blk = bytes(blk)
+    mf = MatchFinder(blk, self.history, self.M, self.maxlen)
     pos = 0 
     while pos < len(blk): 
-      k = blk[pos:pos+self.M] 
-      older = (pos - self.history - 1) 
-      candidates = [p for p in lempel.get(k, []) if (older < p)] 
-      (bestlen, bestpos) = max([(0, 0)] + [(prefix(blk[p:pos], blk[pos:]), p) for p in candidates]) 
-      if k in lempel: 
-        lempel[k].add(pos) 
-      else: 
-        lempel[k] = set([pos]) 
-      bestlen = min(bestlen, self.maxlen) 
+      (bestlen, bestpos) = mf.find(pos)
       if bestlen >= self.M:
-        sched.append((bestpos - pos, bestlen)) 
+        yield (bestpos - pos, bestlen)
+        for p in range(pos + 1, pos + bestlen):
+          mf.insert(p)
         pos += bestlen
       else: 
-        sched.append(blk[pos]) 
+        yield blk[pos]
         pos += 1
-    return sched
-  def toarray(self, blk): 
-    bs = Bitstream()
+  def optimal_schedule(self, blk):
+    """ Minimum-bit parse: cost[i] = min(9 + cost[i+1], refsize + min(cost[i+M..i+len_i]))
+        where len_i is the longest match at i - any shorter length reuses the same offset """
+    blk = bytes(blk)
+    n = len(blk)
+    mf = MatchFinder(blk, self.history, self.M, self.maxlen)
+    matches = mf.find_all()
+    refsize = 1 + self.b_off + self.b_len
+    # (cost, position) packed in a single int, ties go to the longest match
+    shift = (n + 1).bit_length()
+    mask = (1 << shift) - 1
+    costs = RangeMin(n + 1, float('inf'))
+    costs.update(n, mask - n)
+    cost = [0] * (n + 1)
+    # match length at i (0: literal)
+    step = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+      cost[i] = 9 + cost[i + 1]
+      l = matches[i][0]
+      if l >= self.M:
+        best = costs.query(i + self.M, i + l)
+        c = refsize + (best >> shift)
+        if c < cost[i]:
+          cost[i] = c
+          step[i] = (mask - (best & mask)) - i
+      costs.update(i, (cost[i] << shift) | (mask - i))
+    self.bits = 10 + cost[0]
+    pos = 0
+    while pos < n:
+      l = step[pos]
+      if l:
+        yield (matches[pos][1] - pos, l)
+        pos += l
+      else:
+        yield blk[pos]
+        pos += 1
+  def compress(self, blk): 
+    return list(self.schedule(blk))
+  def toarray(self, blk, limit=None): 
+    """ Encode blk - returns None as soon as output exceeds limit bytes (if any) """
+    bs = BitWriter()
     bs.append(4, self.b_off) 
     bs.append(4, self.b_len) 
     bs.append(2, self.M)
     # total size: not needed for this project
     # bs.append(32, len(blk)) 
-    sched = self.compress(blk) 
-    for c in sched: 
+    for c in self.schedule(blk): 
       if type(c) is tuple: 
         (offset, l) = c 
         bs.append(1, 1) 
@@ -82,7 +267,29 @@ class Codec(object):
       else: 
         bs.append(1, 0) 
         bs.append(8, c) 
+      if limit is not None and len(bs) > limit:
+        return None
     return bs.toarray()
+  @staticmethod
+  def frombytes(data):
+    """ Decode a stream written by toarray (reference decoder, see p8decode.py for the lzs.lua mirror) """
+    br = BitReader(data)
+    b_off, b_len, M = br.read(4), br.read(4), br.read(2)
+    cc = Codec(b_off = b_off, b_len = b_len)
+    if cc.M != M:
+      raise Exception("Invalid LZS header: O:{} L:{} M:{}".format(b_off, b_len, M))
+    def sched():
+      total = 8 * len(data)
+      while br.tell() < total:
+        remaining = total - br.tell()
+        if br.read(1):
+          yield (-br.read(b_off) - 1, br.read(b_len) + M)
+        elif remaining < 9:
+          # zero padding of last byte
+          break
+        else:
+          yield br.read(8)
+    return cc.decompress(sched())
   def to_cfile(self, hh, blk, name): 
     print("static PROGMEM prog_uchar %s[] = {" % name, file=hh)
     bb = self.toarray(blk) 
@@ -93,13 +300,77 @@ class Codec(object):
         print("0x%02x, " % c, end='', file=hh)
     print("};",file=hh)
   def decompress(self, sched): 
-    s = "" 
+    """ Rebuild bytes from a schedule: literals (int) and back references (negative offset, length)
+        see p8decode.py for the bitstream decoder """
+    out = bytearray()
     for c in sched: 
-      if len(c) == 1: 
-        s += c 
-      else: 
+      if type(c) is tuple: 
         (offset, l) = c 
+        # overlapping copy (offset can be smaller than length)
+        start = len(out) + offset
         for i in range(l): 
-          s += s[offset] 
-    return s 
+          out.append(out[start + i])
+      else:
+        out.append(c)
+    return bytes(out)
+
+
+
+# LZB: byte-aligned LZ (LZ4-like) - trades a bit of ratio for a much cheaper decoder
+# stream: window bits (1 byte), then sequences of:
+#  token: literal count (high nibble) | match length code (low nibble, 0: no match)
+#  [literal count extension: bytes added while 255]
+#  [match offset - 1: 1 byte if window <= 256, 2 bytes (little endian) otherwise]
+#  [match length extension: bytes added while 255]
+#  literals
+# match length is code + min_len - 1, literals are copied before the match
+class ByteCodec(object):
+  def __init__(self, b_off=8):
+    self.b_off = b_off
+    self.history = 2 ** b_off
+    self.wide = b_off > 8
+    # smallest match that saves a byte
+    self.M = self.wide and 4 or 3
+    self.maxlen = 0xffff
+
+  def schedule(self, blk):
+    """ Yield (literals, offset, length) sequences - last one may have no match (length 0) """
+    blk = bytes(blk)
+    mf = MatchFinder(blk, self.history, self.M, self.maxlen)
+    pos = start = 0
+    while pos < len(blk):
+      (bestlen, bestpos) = mf.find(pos)
+      if bestlen >= self.M:
+        yield (blk[start:pos], pos - bestpos, bestlen)
+        for p in range(pos + 1, pos + bestlen):
+          mf.insert(p)
+        pos += bestlen
+        start = pos
+      else:
+        pos += 1
+    if start < len(blk):
+      yield (blk[start:], 0, 0)
+
+  def ext(self, bb, n):
+    while n >= 255:
+      bb.append(255)
+      n -= 255
+    bb.append(n)
 
+  def toarray(self, blk, limit=None):
+    """ Encode blk - returns None as soon as output exceeds limit bytes (if any) """
+    bb = bytearray([self.b_off])
+    for (lits, offset, l) in self.schedule(blk):
+      nlits = len(lits)
+      code = l and l - self.M + 1 or 0
+      bb.append((min(nlits, 15) << 4) | min(code, 15))
+      if nlits >= 15:
+        self.ext(bb, nlits - 15)
+      if l:
+        bb += (offset - 1).to_bytes(self.wide and 2 or 1, 'little')
+        if code >= 15:
+          self.ext(bb, code - 15)
+      bb += lits
+      if limit is not None and len(bb) > limit:
+        return None
+    return array.array('B', bb)
@@ -1,82 +1,333 @@
 import os
-from subprocess import Popen, PIPE
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import tempfile
+import shutil
+import json
 import logging
 import argparse
 from python2pico import *
-from lzs import Codec
+from packer import *
+from lzs import Codec, ByteCodec, CODEC_RAW, CODEC_LZS, CODEC_LZB, LZS_MAX_B_OFF
 from dotdict import dotdict
+from cache import ExportCache
+from jobs import make_job, run_jobs
+from timeline import timeline
+from budget import archive_budget, log_report, save_report, load_report, compare_reports
 
 local_dir = os.path.dirname(os.path.realpath(__file__))
 blender_exe = os.path.expandvars(os.path.join("%programfiles%","Blender Foundation","Blender 2.92","blender.exe"))
 
-def call(args):
-    proc = Popen(args, stdout=PIPE, stderr=PIPE, cwd=local_dir)
-    out, err = proc.communicate()
-    exitcode = proc.returncode
-    #
-    return exitcode, out, err
-
-# compress the given byte string
-# raw = True returns an array of bytes (a byte string otherwise)
-def compress_byte_str(s,raw=False,more=False):
-  b = bytes.fromhex(s)
-  min_size = len(b)
+# compression search (worker side)
+# blob and best size so far are shared by all workers of the pool
+_search_blob = None
+_search_best = None
+
+def _init_search(blob, best):
+  global _search_blob, _search_best
+  _search_blob = blob
+  _search_best = best
+
+def _try_codec(params):
+  b_off, b_len = params
+  start = time.perf_counter()
+  # give up as soon as output is larger than best result so far
+  compressed = Codec(b_off = b_off, b_len = b_len).toarray(_search_blob, limit = _search_best.value)
+  size = compressed is not None and len(compressed) or None
+  if size is not None:
+    with _search_best.get_lock():
+      if size < _search_best.value:
+        _search_best.value = size
+  return b_off, b_len, size, time.perf_counter() - start
+
+# brute force search of the best (b_off, b_len) pair
+# note: window is capped to what lzs.lua can decode (see lzs.LZS_MAX_B_OFF)
+def search_codec_params(b, offsets=range(4,LZS_MAX_B_OFF+1), lengths=range(16)):
+  logging.info("Compression search: window up to {} bytes (O:{}-{})".format(1<<max(offsets), min(offsets), max(offsets)))
+  grid = [(o,l) for o in offsets for l in lengths]
+  start = time.perf_counter()
+  best = multiprocessing.Value('i', len(b) + 1)
+  results = []
+  with ProcessPoolExecutor(initializer=_init_search, initargs=(b, best)) as pool:
+    jobs = [pool.submit(_try_codec, params) for params in grid]
+    for job in tqdm(as_completed(jobs), total=len(jobs), desc="Compression optimization"):
+      b_off, b_len, size, elapsed = job.result()
+      logging.debug("O:{} L:{} - size: {} ({}s)".format(b_off, b_len, size is None and "aborted" or size, round(elapsed,2)))
+      if size is not None:
+        results.append((size, b_off, b_len))
+  if not results:
+    raise Exception("Unable to find compression parameters")
+  min_size, min_off, min_len = min(results)
+  logging.info("Best compression parameters: O:{} L:{} - ratio: {}% ({} tries in {}s)".format(min_off, min_len, round(100*min_size/len(b),2), len(grid), round(time.perf_counter() - start,2)))
+  return min_off, min_len
+
+# compress the given bytes, returns compressed bytes and codec parameters
+# optimal = True uses the minimum-bit parse (parameter search stays greedy)
+def compress_bytes(b,more=False,optimal=False):
   min_off = 8
   min_len = 3
   if more:
-    for l in tqdm(range(8), desc="Compression optimization"):
-      cc = Codec(b_off = min_off, b_len = l) 
-      compressed = cc.toarray(b)
-      if len(compressed)<min_size:
-        min_size=len(compressed)
-        min_len = l      
-  
-    logging.debug("Best compression parameters: O:{} L:{} - ratio: {}%".format(min_off, min_len, round(100*min_size/len(b),2)))
+    min_off, min_len = search_codec_params(b)
 
   # LZSS compressor  
-  cc = Codec(b_off = min_off, b_len = min_len) 
+  cc = Codec(b_off = min_off, b_len = min_len, optimal = optimal) 
   compressed = cc.toarray(b)
-  if raw:
-    return compressed
-  return "".join(map("{:02x}".format, compressed))
+  if optimal:
+    greedy = Codec(b_off = min_off, b_len = min_len).toarray(b)
+    logging.info("Optimal parse: {} bytes (greedy: {} bytes) - saved: {} bytes".format(len(compressed), len(greedy), len(greedy) - len(compressed)))
+  logging.debug("Compression ratio: {}%".format(round(100*len(compressed)/len(b),2)))
+  return bytes(compressed), dict(b_off=min_off, b_len=min_len, optimal=optimal)
+
+# compress the given bytes with the byte-aligned codec, returns compressed bytes and codec parameters
+# more = True tries all window sizes up to 4096 bytes (ring buffer is a Lua table on cart)
+def compress_bytes_lzb(b,more=False):
+  offsets = more and range(4,13) or [8]
+  compressed = min((ByteCodec(b_off = o).toarray(b) for o in offsets), key=len)
+  logging.debug("Compression ratio: {}% (window: {})".format(round(100*len(compressed)/len(b),2), 1<<compressed[0]))
+  return bytes(compressed), dict(b_off=compressed[0])
+
+# codec name -> archive id
+codecs = {
+  "raw": CODEC_RAW,
+  "lzs": CODEC_LZS,
+  "lzb": CODEC_LZB
+}
+
+# encode the given bytes with the given codec, returns encoded bytes and codec parameters (None: raw)
+# note: codec id is stored in the archive index
+def encode_asset(b,codec="raw",more=False,optimal=False):
+  codec_params = None
+  if codec=="lzs":
+    b, codec_params = compress_bytes(b, more=more, optimal=optimal)
+  elif codec=="lzb":
+    b, codec_params = compress_bytes_lzb(b, more=more)
+  return bytes(b), codec_params
+
+# codec candidates tried per asset: (codec name, codec parameters)
+# more = True: all LZS (b_off, b_len) pairs and LZB window sizes
+def codec_candidates(more=False, optimal=False):
+  candidates = [("raw", None)]
+  candidates += [("lzb", dict(b_off=o)) for o in (more and range(4,13) or [8])]
+  # note: window capped to what lzs.lua can decode
+  grid = more and [(o,l) for o in range(4,LZS_MAX_B_OFF+1) for l in range(16)] or [(8,3)]
+  candidates += [("lzs", dict(b_off=o, b_len=l, optimal=optimal)) for o,l in grid]
+  return candidates
+
+# codec selection (worker side)
+def _encode_candidate(params):
+  j, codec, codec_params, b = params
+  start = time.perf_counter()
+  # never larger than raw
+  if codec=="lzs":
+    encoded = Codec(**codec_params).toarray(b, limit=len(b))
+  elif codec=="lzb":
+    encoded = ByteCodec(**codec_params).toarray(b, limit=len(b))
+  else:
+    encoded = b
+  return j, encoded is not None and bytes(encoded) or None, start, time.perf_counter(), os.getpid()
+
+# encode each asset with its best codec (all candidates run in a process pool)
+# assets: list of (name, bytes)
+# returns list of (name, codec, codec parameters, encoded bytes)
+def encode_assets_best(assets, more=False, optimal=False, jobs=None):
+  tasks = [(i, codec, codec_params) for i in range(len(assets)) for codec,codec_params in codec_candidates(more=more, optimal=optimal)]
+  best = [None] * len(assets)
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = [pool.submit(_encode_candidate, (j, codec, codec_params, assets[i][1])) for j,(i,codec,codec_params) in enumerate(tasks)]
+    for future in tqdm(as_completed(futures), total=len(futures), desc="Codec selection"):
+      j, encoded, start, end, pid = future.result()
+      i, codec, codec_params = tasks[j]
+      logging.debug("{} {} {} - size: {} ({}s)".format(assets[i][0], codec, codec_params, encoded is None and "aborted" or len(encoded), round(end - start,2)))
+      timeline.add_worker("encode:{}".format(assets[i][0]), start, end, pid, codec=codec, params=str(codec_params), size=encoded is not None and len(encoded) or None)
+      # smallest output, ties: first candidate (raw, then fastest to decode)
+      if encoded is not None and (best[i] is None or (len(encoded), j) < best[i][0]):
+        best[i] = ((len(encoded), j), codec, codec_params, encoded)
+
+  # report
+  # optimal: greedy column is the LZS winner encoded with greedy matching (same parameters)
+  logging.info("{:<16} {:>8} {:>8}{} {:>7}  {}".format("asset", "size", "encoded", optimal and " {:>8}".format("greedy") or "", "ratio", "codec"))
+  total, total_encoded, total_greedy = 0, 0, 0
+  for (name,b),(_,codec,codec_params,encoded) in zip(assets,best):
+    total += len(b)
+    total_encoded += len(encoded)
+    greedy = ""
+    if optimal:
+      greedy_size = codec=="lzs" and len(Codec(**dict(codec_params, optimal=False)).toarray(b)) or len(encoded)
+      total_greedy += greedy_size
+      greedy = " {:>8}".format(codec=="lzs" and greedy_size or "-")
+    params = codec_params and " ".join("{}:{}".format(k,v) for k,v in codec_params.items() if k!="optimal") or ""
+    logging.info("{:<16} {:>8} {:>8}{} {:>6.1f}%  {} {}".format(name, len(b), len(encoded), greedy, 100*len(encoded)/max(len(b),1), codec, params))
+  logging.info("{:<16} {:>8} {:>8}{} {:>6.1f}%".format("total", total, total_encoded, optimal and " {:>8}".format(total_greedy) or "", 100*total_encoded/max(total,1)))
+  if optimal:
+    logging.info("Optimal parse: {} bytes (greedy: {} bytes) - saved: {} bytes".format(total_encoded, total_greedy, total_greedy - total_encoded))
+  return [(name, codec, codec_params, encoded) for (name,_),(_,codec,codec_params,encoded) in zip(assets,best)]
+
+# archive index: number of assets + per asset: name, cart id, offset in cart, size, codec id
+def pack_index(entries):
+  s = pack_variant(len(entries))
+  for entry in entries:
+    s += pack_string(entry.name) + pack_byte(entry.cart) + pack_variant(entry.offset) + pack_variant(entry.size) + pack_byte(codecs[entry.codec])
+  return s
 
-def pack_models(home_path):
-    # data buffer
-    blob = ""
+# multi-cart archive: index (first cart) + independently encoded assets
+# assets: list of (name, codec, encoded bytes)
+# an asset is moved to the next cart when it would straddle a cart boundary (unless larger than a cart)
+# returns archive bytes and index entries
+def layout_archive(assets, cart_len=cart_data_len):
+  for name,codec,data in assets:
+    if len(data)>0x7fff:
+      raise Exception("Asset: {} too large ({} bytes), exceeds max. 32767 bytes".format(name, len(data)))
+  # index size depends on asset offsets: repeat until stable
+  # index length only grows (an asset moved to the next cart can shrink its offset), index is padded to that length
+  entries, index_len = [], 0
+  while True:
+    entries = []
+    pos = index_len
+    for name,codec,data in assets:
+      room = cart_len - pos % cart_len
+      if len(data)>room and len(data)<=cart_len:
+        pos += room
+      entries.append(dotdict(name=name, codec=codec, cart=pos // cart_len, offset=pos % cart_len, size=len(data)))
+      pos += len(data)
+    index = pack_index(entries)
+    if len(index)<=index_len:
+      break
+    index_len = len(index)
+  if index_len>cart_len:
+    raise Exception("Archive index too large ({} bytes)".format(index_len))
+  blob = bytearray(index.ljust(index_len, b"\0"))
+  for entry,(_,_,data) in zip(entries,assets):
+    blob += bytes(entry.cart*cart_len + entry.offset - len(blob))
+    blob += data
+  return bytes(blob), entries
+
+# Blender job exporting the given blend files, one output file per model in tmp_dir
+# batch: single Blender session for all files (only one file otherwise)
+def export_job(name, blend_paths, export_args, tmp_dir, batch=True):
+    outs = [os.path.join(tmp_dir, "{}_{}.bin".format(name, i)) for i in range(len(blend_paths))]
+    if not batch:
+        return make_job(name, [blender_exe,blend_paths[0],"--background","--python","blender_export.py","--","--out",outs[0]] + export_args, cwd=local_dir, log_stdout=True), outs
+    manifest_path = os.path.join(tmp_dir, "{}.json".format(name))
+    with open(manifest_path, 'w') as f:
+        json.dump([{"blend": os.path.abspath(blend_path), "out": out} for blend_path,out in zip(blend_paths,outs)], f)
+    return make_job(name, [blender_exe,"--background","--python","blender_export.py","--","--manifest",manifest_path] + export_args, cwd=local_dir, log_stdout=True), outs
+
+# export the given blend files, returns packed models bytes (same order)
+# batch: models are split among sessions Blender processes (one process per model otherwise)
+# sessions: number of batch Blender sessions (default: single Blender startup)
+# jobs: max. number of concurrent Blender processes
+# timeout: max. duration of a Blender process (seconds)
+def export_models(blend_paths, export_args, batch=True, sessions=1, jobs=None, timeout=None):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if batch:
+            # split files among Blender sessions
+            n = max(min(sessions, len(blend_paths)), 1)
+            groups = [blend_paths[i::n] for i in range(n)]
+        else:
+            groups = [[blend_path] for blend_path in blend_paths]
+        specs = [export_job("blender_{}".format(i), group, export_args, tmp_dir, batch=batch) for i,group in enumerate(groups)]
+        with timeline.span("blender", jobs=len(specs), models=len(blend_paths)):
+            run_jobs([job for job,_ in specs], limit=jobs, timeout=timeout)
+        models = {}
+        for group,(_,outs) in zip(groups,specs):
+            for blend_path,out in zip(group,outs):
+                with timeline.span("read:{}".format(os.path.basename(blend_path))), open(out, 'rb') as outfile:
+                    models[blend_path] = outfile.read()
+        return [models[blend_path] for blend_path in blend_paths]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+# exporter code (any change invalidates cached models)
+def exporter_sources():
+    sources = []
+    for name in ["blender_export.py", "packer.py", "geometry.py", "bsp.py", "decimate.py", "dotdict.py"]:
+        with open(os.path.join(local_dir, name), 'rb') as f:
+            sources.append(f.read())
+    return sources
+
+# cache: ExportCache instance (optional)
+# batch: export models in batch Blender sessions
+# sessions: number of batch Blender sessions
+# jobs: max. number of concurrent Blender processes
+# timeout: max. duration of a Blender process (seconds)
+# export_args: blender_export.py options
+# returns a list of (model name, model bytes)
+def pack_models(home_path, cache=None, batch=True, sessions=1, jobs=None, timeout=None, export_args=None):
+    # exporter options
+    export_args = export_args or []
+    sources = cache and exporter_sources()
 
     # 3d models
     file_list = ['mountain','bf109']
-    blob += pack_variant(len(file_list))
+    models = {}
+    keys = {}
     for blend_file in file_list:
-        logging.info("Exporting: {}.blend".format(blend_file))
-        fd, path = tempfile.mkstemp()
-        try:
-            os.close(fd)
-            exitcode, out, err = call([blender_exe,os.path.join(home_path,"models",blend_file + ".blend"),"--background","--python","blender_export.py","--","--out",path])
-            if err:
-                raise Exception('Unable to loadt: {}. Exception: {}'.format(blend_file,err))
-            logging.debug("Blender exit code: {} \n out:{}\n err: {}\n".format(exitcode,out,err))
-            with open(path, 'r') as outfile:
-                blob += pack_string(blend_file)
-                blob += outfile.read()
-        finally:
-            os.remove(path)
-    return blob
-
-def pack_archive(pico_path, home_path, compress=False, release=None, compress_more=False, test=False):
-    blob = ""
+        blend_path = os.path.join(home_path,"models",blend_file + ".blend")
+        if cache:
+            with open(blend_path, 'rb') as f:
+                keys[blend_file] = cache.key(f.read(), *sources, " ".join(export_args).encode())
+            with timeline.span("cache:{}".format(blend_file)):
+                data = cache.get(keys[blend_file])
+            if data is not None:
+                logging.info("Exporting: {}.blend (cached)".format(blend_file))
+                models[blend_file] = data
+
+    # export missing models
+    missing = [blend_file for blend_file in file_list if blend_file not in models]
+    if missing:
+        blend_paths = [os.path.join(home_path,"models",blend_file + ".blend") for blend_file in missing]
+        logging.info("Exporting: {}".format(", ".join(blend_file + ".blend" for blend_file in missing)))
+        exported = export_models(blend_paths, export_args, batch=batch, sessions=sessions, jobs=jobs, timeout=timeout)
+        for blend_file,data in zip(missing,exported):
+            models[blend_file] = data
+            if cache:
+                cache.put(keys[blend_file], data)
+
+    return [(blend_file, models[blend_file]) for blend_file in file_list]
+
+# pico_path: PICO-8 folder, only used to write carts with PICO-8 (legacy)
+# budget: save byte budget report to this file (optional)
+# budget_baseline: compare byte budget with this report (optional)
+# dry_run: encode assets but do not write carts
+def pack_archive(pico_path, home_path, codec="raw", release=None, compress_more=False, optimal=False, test=False, cache=None, batch=True, sessions=1, jobs=None, timeout=None, export_args=None, budget=None, budget_baseline=None, dry_run=False):
     # todo: pack map
 
     # pack models
-    blob = pack_models(home_path)
+    with timeline.span("export"):
+        models = pack_models(home_path, cache=cache, batch=batch, sessions=sessions, jobs=jobs, timeout=timeout, export_args=export_args)
 
     if not test:
-        game_data = compress and compress_byte_str(blob, more=compress_more) or blob
-        # must fit into the 0x8000 extended region
-        data_len = int(len(game_data)/2)
-        if data_len>32767:
-            raise Exception("Game data too large ({} bytes), exceeds max. 32767 bytes".format(data_len))
+        # one asset per model (decoded on demand, see archive.lua)
+        if codec=="best":
+            with timeline.span("codec selection"):
+                encoded = encode_assets_best(models, more=compress_more, optimal=optimal, jobs=jobs)
+        else:
+            encoded = []
+            for name,data in models:
+                with timeline.span("encode:{}".format(name), codec=codec, size=len(data)):
+                    data, codec_params = encode_asset(data, codec=codec, more=compress_more, optimal=optimal)
+                    encoded.append((name, codec, codec_params, data))
+        assets = [(name, asset_codec, data) for name,asset_codec,_,data in encoded]
+        with timeline.span("layout"):
+            game_data, entries = layout_archive(assets)
+        for entry in entries:
+            logging.info("Asset: {} cart: {} offset: 0x{:04x} size: {} ({})".format(entry.name, entry.cart, entry.offset, entry.size, entry.codec))
+
+        if budget or budget_baseline:
+            with timeline.span("budget"):
+                # codec and parameters picked by the build
+                choices = {name: (asset_codec, codec_params) for name,asset_codec,codec_params,_ in encoded}
+                report = archive_budget(models, choices, archive_len=len(game_data), index_len=len(pack_index(entries)), cart_len=cart_data_len)
+                log_report(report)
+                if budget:
+                    save_report(report, budget)
+                if budget_baseline:
+                    compare_reports(report, load_report(budget_baseline))
+
+        if dry_run:
+            return
 
         # pack data
         bootloader_code="""\
@@ -89,28 +340,52 @@ __lua__
 -- generated code - do not edit
 -- *********************************
 function _init()
-    -- enable 0x8000 memory region
-    poke(0x5f36,0x10)
-    memcpy(0x8000,0x0,32767)
     load("game")
 end
 """
-        to_multicart(game_data, pico_path, os.path.join(home_path,"carts"), "dat", boot_code=bootloader_code)
+        with timeline.span("carts", bytes=len(game_data)):
+            to_multicart(game_data, pico_path, os.path.join(home_path,"carts"), "dat", boot_code=bootloader_code, jobs=jobs, timeout=timeout)
 
 def main():
   global blender_exe
   parser = argparse.ArgumentParser()
-  parser.add_argument("--pico-home", required=True, type=str, help="Full path to PICO8 folder")
+  parser.add_argument("--pico-home", required=False, type=str, help="Full path to PICO8 folder (only needed with --pico-export)")
+  parser.add_argument("--pico-export", action='store_true', required=False, help="Use PICO-8 to write sfx/music cart sections (default: false, carts are written by python)")
   parser.add_argument("--home", required=True, type=str, help="Root of game files (carts, models...)")
-  parser.add_argument("--compress", action='store_true', required=False, help="Enable compression (default: false)")
-  parser.add_argument("--compress-more", action='store_true', required=False, help="Brute force search of best compression parameters. Warning: takes time (default: false)")
+  parser.add_argument("--compress", action='store_true', required=False, help="Enable compression (default: false). Same as: --codec lzs")
+  parser.add_argument("--codec", choices=list(codecs.keys()) + ["best"], required=False, type=str, help="Asset codec: raw, lzs (bitwise, best ratio), lzb (byte-aligned, fast to decode) or best (smallest per asset, candidates run on --jobs cores, all parameters with --compress-more). Note: game cart must include archive.lua and the matching decoders (plain.lua, lzs.lua, lzb.lua)")
+  parser.add_argument("--compress-more", action='store_true', required=False, help="Brute force search of best compression parameters, using all cores (default: false)")
+  parser.add_argument("--optimal-parse", action='store_true', required=False, help="Minimum size LZS encoding instead of greedy matching (default: false)")
   parser.add_argument("--release", required=False,  type=str, help="Generate html+bin packages with given version. Note: compression mandatory if number of carts above 16.")
   parser.add_argument("--test", action='store_true', required=False, help="Test mode - does not write cart data")
-  parser.add_argument("--blender-location", required=False, type=str, help="Full path to Blender 2.9+ executable (default: {})".format(blender_exe))
+  parser.add_argument("--no-cache", action='store_true', required=False, help="Always export models with Blender (default: false)")
+  parser.add_argument("--cache-dir", required=False, type=str, default=os.path.join(os.path.expanduser("~"),".cache","finest_hours"), help="Exported models cache folder (default: %(default)s)")
+  parser.add_argument("--cache-size", required=False, type=int, default=64, help="Max. size of exported models cache in MB (default: %(default)s)")
+  parser.add_argument("--no-batch", action='store_true', required=False, help="Start one Blender process per model (default: false, all models are exported in --blender-sessions Blender processes)")
+  parser.add_argument("--blender-sessions", required=False, type=int, default=1, help="Number of batch Blender processes models are split among (default: %(default)s, single Blender startup)")
+  parser.add_argument("-j", "--jobs", required=False, type=int, default=os.cpu_count(), help="Max. number of concurrent Blender/PICO-8 processes (default: %(default)s)")
+  parser.add_argument("-v", "--verbose", action='store_true', required=False, help="Debug logging (all Blender/PICO-8 output, codec search details)")
+  parser.add_argument("--timeout", required=False, type=int, default=600, help="Max. duration of a Blender/PICO-8 process in seconds (default: %(default)s)")
+  parser.add_argument("--bsp", action='store_true', required=False, help="Export models with a precomputed draw order (BSP tree) instead of per-frame sorting (default: false)")
+  parser.add_argument("--lods", required=False, type=int, help="Number of LODs, missing LOD collections are generated (default: 2)")
+  parser.add_argument("--lod-dist", required=False, type=int, nargs='+', help="Visibility range of generated LODs, indexed by LOD number (default: twice the previous LOD range)")
+  parser.add_argument("--lod-ratio", required=False, type=float, help="Number of triangles of a generated LOD, relative to previous LOD (default: 0.5)")
+  parser.add_argument("--normal-error", required=False, type=float, help="Max. angle between a face normal and its shared normal, in degrees (default: 1.0)")
+  parser.add_argument("--vertex-error", required=False, type=float, help="Max. vertex position error, per axis (default: 1/32)")
+  parser.add_argument("--budget", required=False, type=str, help="Byte budget report (JSON): raw and compressed bytes per model, LOD, section and field")
+  parser.add_argument("--budget-baseline", required=False, type=str, help="Compare byte budget with a saved --budget report")
+  parser.add_argument("--dry-run", action='store_true', required=False, help="Export and encode assets but do not write carts (default: false)")
+  parser.add_argument("--profile", required=False, type=str, help="Write a Chrome trace (JSON) of build stages: wall/cpu time, peak RSS, Blender/PICO-8 processes (open with chrome://tracing or ui.perfetto.dev)")
+  parser.add_argument("--cprofile", action='store_true', required=False, help="Also profile Python stages with cProfile (requires --profile, stats saved next to trace file)")
+  parser.add_argument("--blender-location", required=False, type=str, help="Full path to Blender 2.9+ executable (default: {})".format(blender_exe.replace("%","%%")))
 
   args = parser.parse_args()
+  if args.pico_export and not args.pico_home:
+    parser.error("--pico-export requires --pico-home")
+  if args.cprofile and not args.profile:
+    parser.error("--cprofile requires --profile")
 
-  logging.basicConfig(level=logging.INFO)
+  logging.basicConfig(level=args.verbose and logging.DEBUG or logging.INFO)
   if args.blender_location:
     blender_exe = args.blender_location
   logging.debug("Blender location: {}".format(blender_exe))
@@ -118,7 +393,35 @@ def main():
   if not os.path.isfile(os.path.join(blender_exe)):
     raise Exception("Unable to locate Blender app at: {}".format(blender_exe))
 
-  pack_archive(args.pico_home, args.home, compress=args.compress or args.compress_more, release=args.release, compress_more=args.compress_more, test=args.test)
+  cache = None
+  if not args.no_cache:
+    cache = ExportCache(args.cache_dir, max_size=args.cache_size*1024*1024)
+
+  # exporter options
+  export_args = []
+  if args.bsp:
+    export_args.append("--bsp")
+  if args.lods is not None:
+    export_args += ["--lods", str(args.lods)]
+  if args.lod_dist:
+    export_args += ["--lod-dist"] + [str(d) for d in args.lod_dist]
+  if args.lod_ratio is not None:
+    export_args += ["--lod-ratio", str(args.lod_ratio)]
+  if args.normal_error is not None:
+    export_args += ["--normal-error", str(args.normal_error)]
+  if args.vertex_error is not None:
+    export_args += ["--vertex-error", str(args.vertex_error)]
+
+  codec = args.codec
+  if not codec:
+    codec = (args.compress or args.compress_more or args.optimal_parse) and "lzs" or "raw"
+  if args.profile:
+    timeline.start(cprofile=args.cprofile)
+  with timeline.span("build", codec=codec):
+    pack_archive(args.pico_export and args.pico_home or None, args.home, codec=codec, release=args.release, compress_more=args.compress_more, optimal=args.optimal_parse, test=args.test, cache=cache, batch=not args.no_batch, sessions=args.blender_sessions, jobs=args.jobs, timeout=args.timeout, export_args=export_args, budget=args.budget, budget_baseline=args.budget_baseline, dry_run=args.dry_run)
+  if args.profile:
+    timeline.summary()
+    timeline.save(args.profile)
   logging.info('DONE')
     
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+from dotdict import dotdict
+
+# python mirror of game.p8 unpack_model (model bytes, as written by blender_export.export_scene)
+# every read is recorded with its section and field kind (see budget.py)
+
+FACE_FLAG_ANIMFRAME = 0x10
+FACE_FLAG_DECALS = 0x8
+FACE_FLAG_QUAD = 0x2
+
+class ModelReader(object):
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.pos = 0
+        self.path = ()
+        # (start, size, section, field kind)
+        self.fields = []
+
+    @contextmanager
+    def section(self, name):
+        path = self.path
+        self.path = path + (name,)
+        try:
+            yield
+        finally:
+            self.path = path
+
+    # streaming readers: make n more bytes available (see p8decode.StreamReader)
+    def fill(self, n):
+        pass
+
+    def read(self, n, kind):
+        self.fill(n)
+        if self.pos + n > len(self.data):
+            raise EOFError("Model data exhausted at: {} ({})".format(self.pos, "/".join(self.path)))
+        b = self.data[self.pos:self.pos+n]
+        self.fields.append((self.pos, n, "/".join(self.path) or "header", kind))
+        self.pos += n
+        return b
+
+    def byte(self):
+        return self.read(1, "byte")[0]
+
+    # see packer.pack_variant
+    def variant(self):
+        self.fill(1)
+        h = self.data[self.pos:self.pos+1]
+        if h and h[0] & 0x80:
+            b = self.read(2, "variant2")
+            return (b[0] & 0x7f) << 8 | b[1]
+        return self.read(1, "variant1")[0]
+
+    # see packer.pack_double
+    def double(self):
+        b = self.read(2, "double")
+        return ((b[0] << 8 | b[1]) - 16384)/128
+
+    # y-up vector
+    def vector(self):
+        return (self.double(), self.double(), self.double())
+
+    # see packer.pack_fixed
+    def fixed(self):
+        x = int.from_bytes(self.read(4, "fixed"), 'big', signed=True)
+        return x/65536
+
+    def string(self):
+        n = self.variant()
+        return self.read(n, "string").decode('ascii')
+
+    # see geometry.VertexQuantizer.pack
+    def vertex(self, encoding):
+        v = []
+        for origin in encoding.origin:
+            b = self.read(encoding.nbytes, "vertex{}".format(encoding.nbytes))
+            q = encoding.nbytes==1 and b[0] - 128 or int.from_bytes(b, 'big', signed=True)
+            v.append(origin + q*encoding.scale)
+        return tuple(v)
+
+def read_face(r, verts):
+    flags = r.byte()
+    face = dotdict(flags=flags, color=r.byte(), frame=None, decals=[])
+    if flags & FACE_FLAG_ANIMFRAME:
+        face.frame = r.byte()
+    face.verts = [verts[r.variant()-1] for _ in range(flags & FACE_FLAG_QUAD and 4 or 3)]
+    if flags & FACE_FLAG_DECALS:
+        with r.section("decals"):
+            face.decals = [read_face(r, verts) for _ in range(r.variant())]
+    return face
+
+def read_bsp_node(r, nodes):
+    count, children = r.variant(), r.byte()
+    nodes.append((count, children))
+    if children & 1:
+        read_bsp_node(r, nodes)
+    if children & 2:
+        read_bsp_node(r, nodes)
+
+# model from bytes (reader positioned at model start)
+def read_model(r):
+    model = dotdict(anchors={}, hulls={}, lods=[])
+    with r.section("normals"):
+        model.normals = [r.vector() for _ in range(r.variant())]
+    with r.section("vertex_encoding"):
+        model.encoding = dotdict(nbytes=r.byte(), origin=r.vector(), scale=r.fixed())
+    with r.section("anchors"):
+        for _ in range(r.variant()):
+            model.anchors[r.byte()] = dotdict(pos=r.vector(), n=r.vector())
+    with r.section("hulls"):
+        for _ in range(r.variant()):
+            hull_id = r.byte()
+            hull = dotdict(center=r.vector(), radius=r.double(), planes=[])
+            for _ in range(r.variant()):
+                hull.planes.append((model.normals[r.variant()-1], r.double()))
+            model.hulls[hull_id] = hull
+    for i in range(r.variant()):
+        with r.section("lod{}".format(i)):
+            lod = dotdict(dist=r.variant(), bsp=[])
+            with r.section("vertices"):
+                verts = [r.vertex(model.encoding) for _ in range(r.variant())]
+            lod.verts = verts
+            with r.section("faces"):
+                lod.faces = []
+                for _ in range(r.variant()):
+                    face = read_face(r, verts)
+                    face.normal = model.normals[r.variant()-1]
+                    lod.faces.append(face)
+            with r.section("bsp"):
+                if r.variant() > 0:
+                    read_bsp_node(r, lod.bsp)
+            model.lods.append(lod)
+    return model
+
+# model from bytes, returns (model, reader)
+def parse_model(data):
+    r = ModelReader(data)
+    model = read_model(r)
+    if r.pos != len(r.data):
+        raise Exception("Trailing model data: {} bytes".format(len(r.data) - r.pos))
+    return model, r
@@ -0,0 +1,431 @@
+import os
+import json
+import argparse
+from dotdict import dotdict
+from lzs import Codec, CODEC_RAW, CODEC_LZS, CODEC_LZB
+from python2pico import read_cart, cart_data_len
+from model_reader import ModelReader, read_model
+
+# python mirror of the cart side asset loading:
+# carts/archive.lua (index, cart switching), plain.lua, lzs.lua, lzb.lua (decoders) and game.p8 unpack_model
+# decoders follow the Lua code statement by statement and count the operations the Lua VM would run
+# cycle costs are rough estimates (calibrate against stat(1) on PICO-8)
+
+# Lua VM budget (approx.)
+CPU_HZ = 8000000
+FPS = 30
+
+# approx. cycles per operation
+CYCLES = dict(
+    # function/closure call + return
+    call=4,
+    # simple instruction: arithmetic, compare, branch, local/upvalue access
+    op=1,
+    # @addr
+    peek=1,
+    # table get/set
+    index=2,
+    # add()/deli() builtins (shifted elements counted separately)
+    add=6,
+    deli=6,
+    # element moved by deli(t,1)
+    shift=1,
+    # table constructor
+    table=10,
+    # reload() of cart data (0x4300 bytes)
+    reload=cart_data_len//4)
+
+# approx. Lua 5.2 memory use (PICO-8 limit: 2MB)
+TABLE_BYTES = 56
+ARRAY_SLOT_BYTES = 16
+HASH_SLOT_BYTES = 32
+MEMORY_LIMIT = 2048*1024
+
+# operation counters
+class Cost(object):
+    def __init__(self):
+        self.ops = dict.fromkeys(CYCLES, 0)
+        # calls per Lua function
+        self.calls = {}
+        # decoder table elements (live/peak)
+        self.slots = 0
+        self.peak_slots = 0
+
+    def call(self, name, n=1):
+        self.ops["call"] += n
+        self.calls[name] = self.calls.get(name, 0) + n
+
+    def count(self, kind, n=1):
+        self.ops[kind] += n
+
+    def grow(self, n):
+        self.slots += n
+        self.peak_slots = max(self.peak_slots, self.slots)
+
+    def cycles(self):
+        return sum(CYCLES[kind]*n for kind, n in self.ops.items())
+
+# memory of a table with the given array/hash sizes (Lua sizes parts to powers of 2)
+def table_bytes(narray=0, nhash=0):
+    def pow2(n):
+        return n and 1 << (n-1).bit_length() or 0
+    return TABLE_BYTES + ARRAY_SLOT_BYTES*pow2(narray) + HASH_SLOT_BYTES*pow2(nhash)
+
+# archive.lua load_asset read(): reads from cart data, reloads the next cart past 0x42ff
+# size: asset size (reading past the asset raises EOFError)
+class CartReader(object):
+    def __init__(self, carts, cart_id, offset, size, cost):
+        self.carts = carts
+        self.cart_id = cart_id
+        self.mem = offset
+        self.size = size
+        self.consumed = 0
+        self.cost = cost
+        self.reload()
+
+    def reload(self):
+        if self.cart_id >= len(self.carts):
+            raise Exception("Missing cart: #{}".format(self.cart_id))
+        self.data = self.carts[self.cart_id]
+        self.cost.count("reload")
+
+    def __call__(self):
+        if self.consumed >= self.size:
+            raise EOFError("Read past asset end ({} bytes)".format(self.size))
+        cost = self.cost
+        cost.call("read")
+        cost.count("op", 4)
+        if self.mem > 0x42ff:
+            self.cart_id += 1
+            self.mem = 0
+            cost.count("op", 3)
+            self.reload()
+        b = self.data[self.mem]
+        cost.count("peek")
+        self.mem += 1
+        self.consumed += 1
+        return b
+
+# plain.lua
+def plain_decoder(read, cost):
+    return read
+
+# lzs.lua
+def lzs_decoder(read, cost):
+    dst, history = [], []
+    src, mask = 0, 0x100
+    def get1():
+        nonlocal src, mask
+        cost.call("get1")
+        cost.count("op", 2)
+        if mask > 0x80:
+            src = read()
+            mask = 1
+            cost.count("op", 2)
+        r = src & mask and 1 or 0
+        mask <<= 1
+        cost.count("op", 6)
+        return r
+    def getn(n):
+        cost.call("getn")
+        cost.count("op", 2 + 3*n)
+        r = 0
+        for _ in range(n):
+            r = get1() | r << 1
+        return r
+    o, l, m = getn(4), getn(4), getn(2)
+    # 16:16 fixed point: 1<<15 wraps to -32768 (and 1<<16 to 0)
+    max_offset = ((1 << o) + 0x8000 & 0xffff) - 0x8000
+    def push(b):
+        cost.call("push")
+        cost.count("add", 2)
+        cost.count("op", 4)
+        dst.append(b)
+        history.append(b)
+        cost.grow(2)
+        if len(history) > max_offset:
+            cost.count("deli")
+            cost.count("shift", len(history) - 1)
+            history.pop(0)
+            cost.grow(-1)
+    def mpeek():
+        cost.call("mpeek")
+        cost.count("op", 3)
+        if not dst:
+            if get1()==0:
+                push(getn(8))
+            else:
+                offset = -getn(o)
+                n = getn(l) + m
+                cost.count("op", 4 + 5*n)
+                for _ in range(n):
+                    i = len(history) + offset
+                    if i < 1:
+                        raise Exception("Invalid back reference: {} ({} bytes of history)".format(offset, len(history)))
+                    cost.count("index")
+                    push(history[i - 1])
+        # pop first byte
+        cost.count("deli")
+        cost.count("shift", len(dst) - 1)
+        cost.grow(-1)
+        return dst.pop(0)
+    return mpeek
+
+# lzb.lua
+def lzb_decoder(read, cost):
+    def ext(n):
+        cost.call("ext")
+        cost.count("op", 2)
+        if n==15:
+            while True:
+                b = read()
+                n += b
+                cost.count("op", 4)
+                if b!=255:
+                    break
+        return n
+    o = read()
+    mask, wide = (1 << o) - 1, o > 8
+    history = {}
+    pos, lits, length, offset = 0, 0, 0, 0
+    def mpeek():
+        nonlocal pos, lits, length, offset
+        cost.call("mpeek")
+        cost.count("op", 3)
+        if lits + length==0:
+            t = read()
+            lits, length = ext(t >> 4), t & 15
+            cost.count("op", 6)
+            if length > 0:
+                offset = read() + 1
+                if wide:
+                    offset += read() << 8
+                length = ext(length) + (wide and 3 or 2)
+                cost.count("op", 8)
+        if lits > 0:
+            lits -= 1
+            b = read()
+            cost.count("op", 3)
+        else:
+            length -= 1
+            b = history[(pos - offset) & mask]
+            cost.count("op", 5)
+            cost.count("index")
+        if pos & mask not in history:
+            cost.grow(1)
+        history[pos & mask] = b
+        pos += 1
+        cost.count("op", 5)
+        cost.count("index")
+        return b
+    return mpeek
+
+DECODERS = {
+    CODEC_RAW: plain_decoder,
+    CODEC_LZS: lzs_decoder,
+    CODEC_LZB: lzb_decoder
+}
+
+# model reader pulling bytes from a decoder (same order as game.p8 mpeek calls)
+class StreamReader(ModelReader):
+    def __init__(self, mpeek):
+        super().__init__(b"")
+        self.data = bytearray()
+        self.mpeek = mpeek
+
+    def fill(self, n):
+        while len(self.data) < self.pos + n:
+            self.data.append(self.mpeek())
+
+# asset index (archive.lua load_archive), carts: list of cart data (0x4300 bytes each)
+def read_index(carts):
+    r = ModelReader(carts[0])
+    index = {}
+    for _ in range(r.variant()):
+        name = r.string()
+        index[name] = dotdict(name=name, cart=r.byte(), offset=r.variant(), size=r.variant(), codec=r.byte())
+    return index
+
+def open_asset(carts, entry, cost):
+    if entry.codec not in DECODERS:
+        raise Exception("Asset: {} unsupported codec: {}".format(entry.name, entry.codec))
+    return DECODERS[entry.codec](CartReader(carts, entry.cart, entry.offset, entry.size, cost), cost)
+
+# all bytes of an asset (decoding stops at the first token past the asset end)
+def decode_asset(carts, entry):
+    out = bytearray()
+    try:
+        mpeek = open_asset(carts, entry, Cost())
+        while True:
+            out.append(mpeek())
+    except EOFError:
+        pass
+    return bytes(out)
+
+# encoded bytes of an asset (as stored in the carts)
+def asset_bytes(carts, entry):
+    data = b"".join(carts[entry.cart:])
+    return data[entry.offset:entry.offset+entry.size]
+
+# approx. cost of game.p8 unpack_model on top of mpeek calls: unpack_* calls and tables
+# returns resident memory of the model tables (bytes)
+def unpack_cost(model, r, cost):
+    for _, size, _, kind in r.fields:
+        if kind.startswith("variant"):
+            cost.call("unpack_variant")
+            cost.count("op", size==2 and 9 or 5)
+        elif kind=="double":
+            cost.call("unpack_double")
+            cost.call("unpack_variant")
+            cost.count("op", 14)
+        elif kind=="fixed":
+            cost.count("op", 14)
+        elif kind.startswith("vertex"):
+            # per component: origin[i]+q*vscale, v[i]=
+            cost.count("op", kind=="vertex2" and 10 or 8)
+            cost.count("index", 2)
+        else:
+            cost.count("op", 2)
+    mem = 0
+    def table(narray=0, nhash=0):
+        nonlocal mem
+        cost.count("table")
+        cost.count("index", narray + nhash)
+        mem += table_bytes(narray, nhash)
+    def array(n):
+        # unpack_array closure calls
+        cost.call("unpack_array")
+        cost.call("fn", n)
+        cost.count("op", 3 + 3*n)
+    def unpack_faces(faces, decal):
+        for face in faces:
+            cost.call("unpack_face")
+            cost.count("op", 24)
+            nhash = 2 + sum(1 for flag in (0x10, 0x1, 0x4, 0x20, 0x8) if face.flags & flag) + (not decal and 2 or 0)
+            table(len(face.verts), nhash)
+            if not decal:
+                # add(lod.f,...) + v_dot
+                cost.count("add")
+                cost.call("v_dot")
+                cost.count("op", 12)
+            if face.decals:
+                table(len(face.decals))
+                array(len(face.decals))
+                cost.count("add", len(face.decals))
+                unpack_faces(face.decals, True)
+    table(0, 3)
+    table(len(model.normals))
+    array(len(model.normals))
+    cost.count("add", len(model.normals))
+    for _ in model.normals:
+        table(3)
+    # origin (temporary)
+    cost.count("table")
+    table(0, len(model.anchors))
+    array(len(model.anchors))
+    for _ in model.anchors.values():
+        table(0, 2)
+        table(3)
+        table(3)
+    array(len(model.hulls))
+    if model.hulls:
+        table(0, len(model.hulls))
+    for hull in model.hulls.values():
+        table(len(hull.planes), 2)
+        table(3)
+        array(len(hull.planes))
+        cost.count("add", len(hull.planes))
+        for _ in hull.planes:
+            table(4)
+    table(len(model.lods))
+    array(len(model.lods))
+    cost.count("add", len(model.lods))
+    for lod in model.lods:
+        table(0, lod.bsp and 3 or 2)
+        table(len(lod.faces))
+        table(len(lod.verts))
+        array(len(lod.verts))
+        cost.count("add", len(lod.verts))
+        for _ in lod.verts:
+            cost.call("unpack_vertex")
+            table(3)
+        array(len(lod.faces))
+        unpack_faces(lod.faces, False)
+        for count, children in lod.bsp:
+            cost.call("unpack_node")
+            cost.count("op", 8 + 4*count)
+            table(count, (children & 1) + (children >> 1 & 1))
+    return mem
+
+# load a model asset as game.p8 get_model does, returns (model, stats)
+def load_model(carts, entry):
+    cost = Cost()
+    r = StreamReader(open_asset(carts, entry, cost))
+    model = read_model(r)
+    decode_cycles = cost.cycles()
+    model_bytes = unpack_cost(model, r, cost)
+    # restore cart data
+    cost.count("reload")
+    cycles = cost.cycles()
+    stats = dotdict(
+        name=entry.name,
+        codec=entry.codec,
+        size=entry.size,
+        decoded=len(r.data),
+        calls=dict(cost.calls),
+        ops=dict(cost.ops),
+        decode_cycles=decode_cycles,
+        cycles=cycles,
+        seconds=cycles/CPU_HZ,
+        frames=cycles*FPS/CPU_HZ,
+        decoder_peak_bytes=cost.peak_slots*ARRAY_SLOT_BYTES,
+        model_bytes=model_bytes)
+    return model, stats
+
+def read_carts(path, name):
+    carts = []
+    while True:
+        cart_path = os.path.join(path, "{}_{}.p8".format(name, len(carts)))
+        if not os.path.isfile(cart_path):
+            break
+        carts.append(read_cart(cart_path))
+    if not carts:
+        raise Exception("No carts: {}_0.p8 in: {}".format(name, path))
+    return carts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode a multi-cart archive as PICO-8 does and estimate loading costs')
+    parser.add_argument('path', type=str, help='Carts folder')
+    parser.add_argument('--name', type=str, default="dat", help='Archive cart name (default: %(default)s)')
+    parser.add_argument('--assets', type=str, nargs='+', help='Assets to load (default: all)')
+    parser.add_argument('--out', type=str, help='Save per asset stats to JSON file')
+    args = parser.parse_args()
+
+    carts = read_carts(args.path, args.name)
+    index = read_index(carts)
+    codec_names = {CODEC_RAW: "raw", CODEC_LZS: "lzs", CODEC_LZB: "lzb"}
+    print("{:<12} {:<5} {:>6} {:>7} {:>7} {:>8} {:>6} {:>6} {:>9} {:>8} {:>10} {:>7} {:>9} {:>9}".format(
+        "asset", "codec", "size", "decoded", "mpeek", "get1", "add", "deli", "shifted", "calls", "cycles", "frames", "peak KB", "model KB"))
+    results = []
+    for name, entry in index.items():
+        if args.assets and name not in args.assets:
+            continue
+        model, stats = load_model(carts, entry)
+        # model must use all decoded bytes (no trailing data)
+        data = decode_asset(carts, entry)
+        if len(data)!=stats.decoded:
+            raise Exception("Asset: {} decoded {} bytes, model uses {} bytes".format(name, len(data), stats.decoded))
+        # lzs.lua mirror must match the reference decoder
+        if entry.codec==CODEC_LZS and data!=Codec.frombytes(asset_bytes(carts, entry)):
+            raise Exception("Asset: {} lzs.lua decoder mismatch".format(name))
+        results.append(stats)
+        ops = stats.ops
+        print("{:<12} {:<5} {:>6} {:>7} {:>7} {:>8} {:>6} {:>6} {:>9} {:>8} {:>10} {:>7.1f} {:>9.1f} {:>9.1f}".format(
+            name, codec_names[entry.codec], entry.size, stats.decoded, stats.calls.get("mpeek", stats.calls.get("read", 0)), stats.calls.get("get1", 0),
+            ops["add"], ops["deli"], ops["shift"], ops["call"], stats.cycles, stats.frames, stats.decoder_peak_bytes/1024, stats.model_bytes/1024))
+    total = sum(stats.cycles for stats in results)
+    print("total: {} cycles ({:.2f}s, {:.1f} frames at {}fps) models: {:.1f}KB (of {}KB)".format(
+        total, total/CPU_HZ, total*FPS/CPU_HZ, FPS, sum(stats.model_bytes for stats in results)/1024, MEMORY_LIMIT//1024))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
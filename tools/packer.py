@@ -0,0 +1,74 @@
+import struct
+
+# binary pack helpers
+# all helpers return bytes - callers append to a bytearray (no quadratic string building)
+
+# wrap value into a nbits unsigned int (two's complement)
+def tounsigned(val, nbits):
+    return (int(round(val,0)) + (1<<nbits)) % (1<<nbits)
+
+# variable length packing (1 or 2 bytes)
+def pack_variant(x):
+    x=int(x)
+    if x<0 or x>0x7fff:
+      raise Exception('Unable to convert: {} into a 1 or 2 bytes'.format(x))
+    # 2 bytes
+    if x>127:
+        return struct.pack('>H', x + 0x8000)
+    # 1 byte
+    return struct.pack('B', x)
+
+# single byte (unsigned short)
+def pack_byte(x):
+    return struct.pack('B', tounsigned(x,8))
+
+# short must be between -32000/32000
+def pack_int(x):
+    return struct.pack('>H', tounsigned(x,16))
+
+def pack_int32(x):
+    return struct.pack('>I', tounsigned(x,32))
+
+# 16:16 fixed point value
+# 4 bytes
+def pack_fixed(x):
+    return struct.pack('>I', tounsigned(int(x*(1<<16)),32))
+
+# short must be between -127/127
+def pack_short(x):
+    h = int(round(x+128,0))
+    if h<0 or h>255:
+        raise Exception('Unable to convert: {} into a byte'.format(x))
+    return struct.pack('B', h)
+
+# float must be between -4/+3.968 resolution: 0.03125
+# 1 byte
+def pack_float(x):
+    h = int(round(32*x+128,0))
+    if h<0 or h>255:
+        raise Exception('Unable to convert: {} into a byte'.format(x))
+    return struct.pack('B', h)
+
+# double must be between -128/+127 resolution: 0.0078
+# 2 bytes
+def pack_double(x):
+    return struct.pack('>H', tounsigned(128*x+16384,16))
+
+def pack_string(s):
+    return pack_variant(len(s)) + s.encode('ascii')
+
+# batch helpers (single struct call)
+def pack_bytes(seq):
+    values = [tounsigned(x,8) for x in seq]
+    return struct.pack('{}B'.format(len(values)), *values)
+
+def pack_doubles(seq):
+    values = [tounsigned(128*x+16384,16) for x in seq]
+    return struct.pack('>{}H'.format(len(values)), *values)
+
+# sequence of (x,y,z) tuples
+def pack_vectors(seq):
+    return pack_doubles(c for v in seq for c in v)
+
+def pack_variants(seq):
+    return b"".join(pack_variant(x) for x in seq)
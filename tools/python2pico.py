@@ -1,6 +1,4 @@
 import os
-import subprocess
-from subprocess import Popen, PIPE
 import re
 import tempfile
 import random
@@ -8,84 +6,14 @@ import math
 import socket
 import shutil
 from tqdm import tqdm
+from jobs import make_job, run_jobs
+from timeline import timeline
 
-def call(args):
-    proc = Popen(args, stdout=PIPE, stderr=PIPE)
-    out, err = proc.communicate()
-    exitcode = proc.returncode
-    #
-    return exitcode, out, err
-
-# pack helpers
-def tohex(val, nbits):
-    return (hex((int(round(val,0)) + (1<<nbits)) % (1<<nbits))[2:]).zfill(nbits>>2)
-
-# variable length packing (1 or 2 bytes)
-def pack_variant(x):
-    x=int(x)
-    if x>0x7fff:
-      raise Exception('Unable to convert: {} into a 1 or 2 bytes'.format(x))
-    # 2 bytes
-    if x>127:
-        h = "{:04x}".format(x + 0x8000)
-        if len(h)!=4:
-            raise Exception('Unable to convert: {} into a word: {}'.format(x,h))
-        return h
-    # 1 byte
-    h = "{:02x}".format(x)
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-
-# single byte (unsigned short)
-def pack_byte(x):
-    h = tohex(x,8)
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-    
-# short must be between -32000/32000
-def pack_int(x):
-    h = tohex(x,16)
-    if len(h)!=4:
-        raise Exception('Unable to convert: {} into a word: {}'.format(x,h))
-    return h
-
-def pack_int32(x):
-    h = tohex(x,32)
-    if len(h)!=8:
-        raise Exception('Unable to convert: {} into a dword: {}'.format(x,h))
-    return h
-
-# 16:16 fixed point value
-# 4 bytes
-def pack_fixed(x):
-    h = tohex(int(x*(1<<16)),32)
-    if len(h)!=8:
-        raise Exception('Unable to convert: {} into a dword: {}'.format(x,h))
-    return h
-
-# short must be between -127/127
-def pack_short(x):
-    h = "{:02x}".format(int(round(x+128,0)))
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-
-# float must be between -4/+3.968 resolution: 0.03125
-# 1 byte
-def pack_float(x):
-    h = "{:02x}".format(int(round(32*x+128,0)))
-    if len(h)!=2:
-        raise Exception('Unable to convert: {} into a byte: {}'.format(x,h))
-    return h
-# double must be between -128/+127 resolution: 0.0078
-# 2 bytes
-def pack_double(x):
-    h = "{}".format(tohex(128*x+16384,16))
-    if len(h)!=4:
-        raise Exception('Unable to convert: {} into a word: {}'.format(x,h))
-    return h
+# cart data size (gfx, map, gfx props, music, sfx)
+cart_data_len = 0x4300
+
+# gfx pixels are stored low nibble first in .p8 files
+NIBBLE_SWAP = bytes(((i & 0xf) << 4) | (i >> 4) for i in range(256))
 
 # convert a byte array to a pico8 safe char set
 def bytes_to_base255(bs):    
@@ -93,13 +21,9 @@ def bytes_to_base255(bs):
     chars = ["\\0","¹","²","³","⁴","⁵","⁶","⁷","⁸","	","\\n","ᵇ","ᶜ","\\r","ᵉ","ᶠ","▮","■","□","⁙","⁘","‖","◀","▶","「","」","¥","•","、","。","゛","゜"," ","!","\\\"","#","$","%","&","'","(",")","*","+",",","-",".","/","\\48","\\49","\\50","\\51","\\52","\\53","\\54","\\55","\\56","\\57",":",";","<","=",">","?","@","A","B","C","D","E","F","G","H","I","J","K","L","M","N","O","P","Q","R","S","T","U","V","W","X","Y","Z","[","\\\\","]","^","_","`","a","b","c","d","e","f","g","h","i","j","k","l","m","n","o","p","q","r","s","t","u","v","w","x","y","z","{","|","}","~","○","█","▒","🐱","⬇️","░","✽","●","♥","☉","웃","⌂","⬅️","😐","♪","🅾️","◆","…","➡️","★","⧗","⬆️","ˇ","∧","❎","▤","▥","あ","い","う","え","お","か","き","く","け","こ","さ","し","す","せ","そ","た","ち","つ","て","と","な","に","ぬ","ね","の","は","ひ","ふ","へ","ほ","ま","み","む","め","も","や","ゆ","よ","ら","り","る","れ","ろ","わ","を","ん","っ","ゃ","ゅ","ょ","ア","イ","ウ","エ","オ","カ","キ","ク","ケ","コ","サ","シ","ス","セ","ソ","タ","チ","ツ","テ","ト","ナ","ニ","ヌ","ネ","ノ","ハ","ヒ","フ","ヘ","ホ","マ","ミ","ム","メ","モ","ヤ","ユ","ヨ","ラ","リ","ル","レ","ロ","ワ","ヲ","ン","ッ","ャ","ュ","ョ","◜","◝"]
     return "".join(chars[b] for b in bs)
 
-def pack_string(s):
-    blob = pack_variant(len(s))
-    for c in s:
-        blob += "{:02x}".format(ord(c))
-    return blob
-
-def to_cart(s,pico_path,carts_path,cart_name,cart_id,cart_code=None, label=None):
+# legacy cart writer: runs PICO-8 to serialize sfx+music sections
+# returns the PICO-8 job writing the cart (see: finish_cart_pico8)
+def cart_job_pico8(data,pico_path,carts_path,cart_name,cart_id):
     cart="""\
 pico-8 cartridge // http://www.pico-8.com
 version 29
@@ -115,33 +39,33 @@ end
 cstore(0, 0, 0x4300, "{}")
 """
 
-    tmp=s[:2*0x2000]
-    # swap bytes
-    gfx_data = ""
-    for i in range(0,len(tmp),2):
-        gfx_data = gfx_data + tmp[i+1:i+2] + tmp[i:i+1]
+    data = memoryview(data)
     cart += "__gfx__\n"
-    cart += re.sub("(.{128})", "\\1\n", gfx_data, 0, re.DOTALL)
+    cart += to_lines(bytes(data[:0x2000]).translate(NIBBLE_SWAP).hex(), 128)
 
-    map_data=s[2*0x2000:2*0x3000]
+    map_data=data[0x2000:0x3000]
     if len(map_data)>0:
         cart += "__map__\n"
-        cart += re.sub("(.{256})", "\\1\n", map_data, 0, re.DOTALL)
+        cart += to_lines(map_data.hex(), 256)
 
-    gfx_props=s[2*0x3000:2*0x3100]
+    gfx_props=data[0x3000:0x3100]
     if len(gfx_props)>0:
         cart += "__gff__\n"
-        cart += re.sub("(.{256})", "\\1\n", gfx_props, 0, re.DOTALL)
+        cart += to_lines(gfx_props.hex(), 256)
 
     # save cart + export cryptic music+sfx part
-    sfx_data=s[2*0x3100:2*0x4300]
+    sfx_data=data[0x3100:0x4300].hex()
     cart_filename = "{}_{}.p8".format(cart_name,cart_id)
-    cart_path = os.path.join(carts_path,"{}_tmp.p8".format(cart_name))
+    cart_path = os.path.join(carts_path,"{}_{}_tmp.p8".format(cart_name,cart_id))
     with open(cart_path, "w") as f:
         f.write(cart.format(cart_name, sfx_data, cart_filename))
     # run cart
-    subprocess.run([os.path.join(pico_path,"pico8"),"-x",os.path.abspath(cart_path)], stdout=PIPE, stderr=PIPE, check=True)
+    return make_job("pico8_{}".format(cart_id), [os.path.join(pico_path,"pico8"),"-x",os.path.abspath(cart_path)])
 
+# replace code and add label to a cart written by PICO-8
+def finish_cart_pico8(carts_path,cart_name,cart_id,cart_code=None, label=None):
+    cart_filename = "{}_{}.p8".format(cart_name,cart_id)
+    cart_path = os.path.join(carts_path,"{}_{}_tmp.p8".format(cart_name,cart_id))
     if cart_code:
         cart = cart_code
         with open(os.path.join(carts_path,cart_filename),"r", encoding='utf-8') as f:
@@ -174,20 +98,150 @@ cstore(0, 0, 0x4300, "{}")
     
     os.unlink(cart_path)
 
-def to_multicart(s,pico_path,carts_path,cart_name,boot_code=None,label=None):
-  cart_id = 0
-  cart_data = ""
-  for b in tqdm(s, desc="Generating carts", unit="bytes"):
-    cart_data += b
-    # full cart?
-    if len(cart_data)==2*0x4300:
-        to_cart(cart_data, pico_path, carts_path, cart_name, cart_id, cart_code=cart_id==0 and boot_code, label=cart_id==0 and label)
-        cart_id += 1
-        cart_data = ""
-  # remaining data?
-  if len(cart_data)!=0:
-    to_cart(cart_data, pico_path, carts_path, cart_name, cart_id, cart_code=cart_id==0 and boot_code, label=cart_id==0 and label)
-  return cart_id
+# split string into lines of n chars
+def to_lines(s, n):
+    return "".join(s[i:i+n] + "\n" for i in range(0, len(s), n))
+
+# write bytes as hex lines of n bytes (no intermediate string)
+def write_hex_lines(f, data, n):
+    for i in range(0, len(data), n):
+        f.write(data[i:i+n].hex())
+        f.write("\n")
+
+# music: 64 patterns x 4 bytes (0x3100)
+# p8 format: flags (bit n = bit 7 of channel n byte) + 4 sfx ids (bit 6: channel disabled)
+def music_to_p8(data):
+    lines = []
+    for i in range(0, len(data), 4):
+        pattern = data[i:i+4]
+        flags = 0
+        for n,b in enumerate(pattern):
+            flags |= (b >> 7) << n
+        lines.append("{:02x} {}".format(flags, bytes(b & 0x7f for b in pattern).hex()))
+    return "".join(line + "\n" for line in lines)
+
+def p8_to_music(lines):
+    data = bytearray()
+    for line in lines:
+        flags, ids = line.split(" ")
+        flags = int(flags, 16)
+        data += bytes(b | ((flags >> n) & 1) << 7 for n,b in enumerate(bytes.fromhex(ids)))
+    return bytes(data)
+
+# sfx: 64 sfx x 68 bytes (0x3200)
+# memory: 32 notes (16 bits, little endian) + editor mode, speed, loop start, loop end
+# note bits: pitch (0-5), waveform (6-8), volume (9-11), effect (12-14), custom instrument (15)
+# p8 format: 4 header bytes + 32 x pitch (2 digits), waveform (+8: custom), volume, effect
+def sfx_to_p8(data):
+    lines = []
+    for i in range(0, len(data), 68):
+        sfx = data[i:i+68]
+        line = [sfx[64:68].hex()]
+        for n in range(0, 64, 2):
+            w = sfx[n] | sfx[n+1] << 8
+            line.append("{:02x}{:x}{:x}{:x}".format(w & 0x3f, (w >> 6) & 0x7 | (w >> 12) & 0x8, (w >> 9) & 0x7, (w >> 12) & 0x7))
+        lines.append("".join(line))
+    return "".join(line + "\n" for line in lines)
+
+def p8_to_sfx(lines):
+    data = bytearray()
+    for line in lines:
+        for n in range(8, 168, 5):
+            pitch, wave, vol, fx = int(line[n:n+2], 16), int(line[n+2], 16), int(line[n+3], 16), int(line[n+4], 16)
+            w = pitch | (wave & 0x7) << 6 | vol << 9 | fx << 12 | (wave & 0x8) << 12
+            data += bytes([w & 0xff, w >> 8])
+        data += bytes.fromhex(line[:8])
+    return bytes(data)
+
+# read back cart data (0x0-0x42ff) from a .p8 file
+def read_cart(path):
+    sections = {}
+    with open(path, "r", encoding='utf-8') as f:
+        name = None
+        for line in f:
+            line = line.rstrip("\n\r")
+            result = re.match("__([a-z]+)__$", line)
+            if result:
+                name = result.groups()[0]
+                sections[name] = []
+            elif name and line:
+                sections[name].append(line)
+    gfx = bytes.fromhex("".join(sections.get("gfx", [])))
+    data = bytearray(0x4300)
+    # pixels are stored low nibble first
+    data[0:len(gfx)] = gfx.translate(NIBBLE_SWAP)
+    map_data = bytes.fromhex("".join(sections.get("map", [])))
+    data[0x2000:0x2000+len(map_data)] = map_data
+    gfx_props = bytes.fromhex("".join(sections.get("gff", [])))
+    data[0x3000:0x3000+len(gfx_props)] = gfx_props
+    music = p8_to_music(sections.get("music", []))
+    data[0x3100:0x3100+len(music)] = music
+    sfx = p8_to_sfx(sections.get("sfx", []))
+    data[0x3200:0x3200+len(sfx)] = sfx
+    return bytes(data)
+
+# write a cart with the given data (bytes-like, up to cart_data_len bytes)
+# pico_path: use PICO-8 to write the sfx+music sections (legacy)
+def to_cart(data,pico_path,carts_path,cart_name,cart_id,cart_code=None, label=None, timeout=None):
+    if pico_path:
+        run_jobs([cart_job_pico8(data,pico_path,carts_path,cart_name,cart_id)], timeout=timeout, check_stderr=False)
+        finish_cart_pico8(carts_path,cart_name,cart_id,cart_code=cart_code,label=label)
+        return
+
+    data = memoryview(data)
+    with open(os.path.join(carts_path,"{}_{}.p8".format(cart_name,cart_id)),"w", encoding='utf-8') as f:
+        f.write(cart_code or """\
+pico-8 cartridge // http://www.pico-8.com
+version 29
+__lua__
+-- {} data cart
+-- @freds72
+""".format(cart_name))
+
+        f.write("__gfx__\n")
+        write_hex_lines(f, bytes(data[:0x2000]).translate(NIBBLE_SWAP), 64)
+
+        # PICO-8 section order: gfx, label, gff, map, sfx, music
+        if label:
+            f.write("__label__\n")
+            f.write(to_lines(label, 128))
+
+        gfx_props=data[0x3000:0x3100]
+        if len(gfx_props)>0:
+            f.write("__gff__\n")
+            write_hex_lines(f, gfx_props, 128)
+
+        map_data=data[0x2000:0x3000]
+        if len(map_data)>0:
+            f.write("__map__\n")
+            write_hex_lines(f, map_data, 128)
+
+        # music+sfx (unused memory is zero)
+        if len(data)>0x3100:
+            sound_data = bytes(data[0x3100:0x4300]).ljust(0x1200, b"\0")
+            f.write("__sfx__\n")
+            f.write(sfx_to_p8(sound_data[0x100:]))
+            f.write("__music__\n")
+            f.write(music_to_p8(sound_data[:0x100]))
+
+# data: archive (bytes-like), split every cart_data_len bytes (archive layout, see make.layout_archive)
+# carts are memoryview windows over data (no copy)
+# jobs: max. number of concurrent PICO-8 processes (legacy writer only)
+# timeout: max. duration of a PICO-8 process (seconds)
+def to_multicart(data,pico_path,carts_path,cart_name,boot_code=None,label=None,jobs=None,timeout=None):
+  data = memoryview(data)
+  carts = [data[i:i+cart_data_len] for i in range(0, len(data), cart_data_len)]
+  if pico_path:
+    # PICO-8 runs concurrently, code+label are added once all carts are written
+    run_jobs([cart_job_pico8(cart_data, pico_path, carts_path, cart_name, cart_id) for cart_id,cart_data in enumerate(carts)], limit=jobs, timeout=timeout, check_stderr=False)
+    for cart_id in range(len(carts)):
+      finish_cart_pico8(carts_path, cart_name, cart_id, cart_code=cart_id==0 and boot_code, label=cart_id==0 and label)
+  else:
+    for cart_id,cart_data in enumerate(carts):
+      with timeline.span("cart:{}_{}".format(cart_name, cart_id), bytes=len(cart_data)):
+        to_cart(cart_data, None, carts_path, cart_name, cart_id, cart_code=cart_id==0 and boot_code, label=cart_id==0 and label)
+  # number of full carts
+  return len(data)//cart_data_len
 
 # read infile and write minified version to outfile
 def minify_file(infile, outfile):
@@ -0,0 +1,126 @@
+import os
+import io
+import json
+import time
+import pstats
+import logging
+import cProfile
+from contextlib import contextmanager
+
+# build profiling: spans written as a Chrome trace (chrome://tracing, https://ui.perfetto.dev)
+# python spans: wall time, cpu time, peak rss (main thread track)
+# subprocess spans (Blender, PICO-8): wall time, one track per concurrent job slot
+# disabled by default - spans cost nothing unless start() is called
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# peak resident set size in KB (self + children), None if unknown
+def peak_rss_kb():
+    if resource is None:
+        return None, None
+    # ru_maxrss: KB on Linux, bytes on macOS
+    unit = os.uname().sysname=="Darwin" and 1024 or 1
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//unit, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss//unit
+
+def children_cpu_time():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Timeline(object):
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.profiler = None
+        self.depth = 0
+        # subprocess tracks: busy flags per track
+        self.tracks = []
+        self.origin = time.perf_counter()
+
+    # cprofile: also profile python spans
+    def start(self, cprofile=False):
+        self.enabled = True
+        self.origin = time.perf_counter()
+        self.profiler = cprofile and cProfile.Profile() or None
+
+    def us(self, t):
+        return int(1e6*(t - self.origin))
+
+    def add(self, name, cat, start, end, tid, args):
+        self.events.append(dict(name=name, cat=cat, ph="X", ts=self.us(start), dur=max(self.us(end) - self.us(start), 1), pid=os.getpid(), tid=tid, args=args))
+
+    # python code span
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        if self.profiler and self.depth==0:
+            self.profiler.enable()
+        self.depth += 1
+        start, cpu, children_cpu = time.perf_counter(), time.process_time(), children_cpu_time()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.depth -= 1
+            if self.profiler and self.depth==0:
+                self.profiler.disable()
+            args = dict(args, cpu_ms=round(1000*(time.process_time() - cpu), 3))
+            rss, children_rss = peak_rss_kb()
+            if rss is not None:
+                args.update(peak_rss_kb=rss, children_peak_rss_kb=children_rss, children_cpu_ms=round(1000*(children_cpu_time() - children_cpu), 3))
+            self.add(name, "python", start, end, 0, args)
+
+    # subprocess span (times measured by caller)
+    def add_process(self, name, start, end, **args):
+        if not self.enabled:
+            return
+        # first track free at start time
+        for track, busy_until in enumerate(self.tracks):
+            if busy_until <= start:
+                break
+        else:
+            track = len(self.tracks)
+            self.tracks.append(0)
+        self.tracks[track] = end
+        self.add(name, "subprocess", start, end, 1 + track, args)
+
+    # worker process span (times measured in another process - perf_counter is system wide)
+    def add_worker(self, name, start, end, pid, **args):
+        if not self.enabled:
+            return
+        self.events.append(dict(name=name, cat="worker", ph="X", ts=self.us(start), dur=max(self.us(end) - self.us(start), 1), pid=pid, tid=pid, args=args))
+
+    def save(self, path):
+        # track names
+        meta = [dict(name="thread_name", ph="M", pid=os.getpid(), tid=0, args=dict(name="python"))]
+        meta += [dict(name="thread_name", ph="M", pid=os.getpid(), tid=1 + track, args=dict(name="subprocess #{}".format(track))) for track in range(len(self.tracks))]
+        meta += [dict(name="process_name", ph="M", pid=pid, tid=pid, args=dict(name="worker {}".format(pid))) for pid in sorted(set(e["pid"] for e in self.events if e["cat"]=="worker"))]
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=meta + self.events, displayTimeUnit="ms"), f)
+        logging.info("Profile trace: {} ({} spans)".format(path, len(self.events)))
+        if self.profiler:
+            prof_path = os.path.splitext(path)[0] + ".prof"
+            self.profiler.dump_stats(prof_path)
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(20)
+            logging.info("cProfile stats: {} (top 20 by cumulative time)\n{}".format(prof_path, out.getvalue()))
+
+    # per span name totals (wall time)
+    def summary(self):
+        totals = {}
+        for e in self.events:
+            total = totals.setdefault((e["cat"], e["name"].split(":")[0]), [0, 0])
+            total[0] += 1
+            total[1] += e["dur"]
+        for (cat, name), (count, dur) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+            logging.info("{:<10} {:<24} x{:<4} {:>10.1f}ms".format(cat, name, count, dur/1000))
+
+# build timeline (single instance, see make.py --profile)
+timeline = Timeline()